@@ -0,0 +1,111 @@
+"""A headless ASGI service for the chatbot. Run it with `uvicorn api:app --workers 4`
+
+POST /chat with JSON {"query": ..., "messages": [...], "conversation_id": ..., "model": ...} and read the answer as
+Server-Sent Events. The server keeps no per-session state: clients send the conversation so far with every request,
+and any worker can answer any request. The conversation_id only lets a worker reuse the rolling summary of older
+turns it has already computed.
+"""
+import json
+import threading
+import uuid
+from collections import OrderedDict
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from chatbot_helper import SYSTEM_MESSAGE, TOOL_CALL_MODEL, acreate_chat_completion_with_rag, get_corpus_version
+from history import ConversationHistory
+from instrumentation import METRICS
+from llm_client import get_scheduler
+
+DEFAULT_MODEL = 'gpt-3.5-turbo'
+MODELS = ('gpt-3.5-turbo', 'gpt-4-turbo-preview')
+CONVERSATION_CACHE_SIZE = 10000  # conversation summaries kept per worker; a miss only costs a re-summary
+
+
+class ConversationSummaries:
+    """An LRU cache of ConversationHistory objects by conversation id"""
+
+    def __init__(self, max_entries=CONVERSATION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.histories = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self.lock:
+            history = self.histories.get(conversation_id)
+            if history is None:
+                history = self.histories[conversation_id] = ConversationHistory()
+            self.histories.move_to_end(conversation_id)
+            while len(self.histories) > self.max_entries:
+                self.histories.popitem(last=False)
+            return history
+
+
+CONVERSATIONS = ConversationSummaries()
+
+
+def server_sent_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def stream_answer(conversation_id, query_text, message_chain, model):
+    yield server_sent_event({"conversation_id": conversation_id}, event="conversation")
+    try:
+        async for text in acreate_chat_completion_with_rag(query_text, message_chain, model):
+            yield server_sent_event({"delta": text})
+    except Exception as error:
+        yield server_sent_event({"error": str(error)}, event="error")
+        return
+    yield server_sent_event({}, event="done")
+
+
+def busy_response():
+    return JSONResponse({"error": "The server is busy, please retry"}, status_code=503, headers={"Retry-After": "1"})
+
+
+async def chat(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({"error": "Request body must be JSON"}, status_code=400)
+
+    query_text = body.get("query")
+    if not isinstance(query_text, str) or not query_text.strip():
+        return JSONResponse({"error": "'query' is required"}, status_code=400)
+    model = body.get("model", DEFAULT_MODEL)
+    if model not in MODELS:
+        return JSONResponse({"error": f"'model' must be one of {', '.join(MODELS)}"}, status_code=400)
+    messages = body.get("messages") or []
+    if not isinstance(messages, list) or not all(isinstance(message, dict) and "role" in message
+                                                 for message in messages):
+        return JSONResponse({"error": "'messages' must be a list of {role, content} objects"}, status_code=400)
+
+    # Shed load before streaming starts, so the load balancer can retry on another worker
+    if get_scheduler().is_saturated(TOOL_CALL_MODEL) or get_scheduler().is_saturated(model):
+        return busy_response()
+
+    conversation_id = body.get("conversation_id") or uuid.uuid4().hex
+    message_chain = CONVERSATIONS.get(conversation_id).build_messages(SYSTEM_MESSAGE, messages)
+
+    return StreamingResponse(stream_answer(conversation_id, query_text, message_chain, model),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def health(request):
+    return JSONResponse({"status": "ok", "corpus_version": get_corpus_version()})
+
+
+async def metrics(request):
+    """Per-stage latency percentiles and token/cache counters, in the Prometheus text format"""
+    return PlainTextResponse(METRICS.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+app = Starlette(routes=[
+    Route("/chat", chat, methods=["POST"]),
+    Route("/health", health, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+])
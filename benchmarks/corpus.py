@@ -0,0 +1,109 @@
+"""Generates a synthetic Stratechery-like corpus: a data.json catalog, one markdown file per article, and
+queries.json with a question per article whose answer only that article contains
+
+    python benchmarks/corpus.py --articles 10000 --output /tmp/corpus
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+PUBLISH_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S +0000"
+LATEST_PUBLISH_DATE = datetime(2024, 3, 25, 14, 0, tzinfo=timezone.utc)
+MAX_CORPUS_DAYS = 5 * 365  # large corpora publish several articles a day rather than reaching back decades
+
+COMPANIES = ("Apple", "Microsoft", "Google", "Meta", "Amazon", "Netflix", "Disney", "Nvidia", "OpenAI", "Tesla",
+             "Intel", "TSMC", "Spotify", "Shopify", "Uber", "Airbnb", "Snap", "ByteDance", "Samsung", "Qualcomm",
+             "Salesforce", "Oracle", "Stripe", "Anthropic", "Activision", "Sony", "Nintendo", "Warner", "Comcast", "X")
+CONCEPTS = ("Aggregation Theory", "the Smiling Curve", "Platform Economics", "Zero Marginal Costs", "Integration",
+            "Modularization", "Bundling", "Unbundling", "the AI Unbundling", "Vertical Integration", "Network Effects",
+            "Advertising", "Subscriptions", "the Cloud", "Chips", "Regulation", "Antitrust", "Distribution",
+            "Content", "Hardware", "Open Source", "Scale", "Attention", "the Metaverse", "Generative AI")
+TITLE_TEMPLATES = ("{company} and {concept}", "{company}'s {concept} Problem", "The {company} {concept} Bet",
+                   "{company}, {other}, and {concept}", "{concept} and the Future of {company}")
+INTERVIEW_GUESTS = ("Nat Friedman and Daniel Gross", "Matthew Ball", "John Gruber", "Eric Seufert", "Jon Yu",
+                    "Michael Nathanson", "Stephanie Link", "Craig Moffett")
+FILLER = ("the market structure suggests that value accrues to whoever controls the customer relationship while "
+          "suppliers compete on price and differentiation erodes over time as distribution becomes free and demand "
+          "aggregates around the best user experience which in turn attracts more suppliers creating a virtuous "
+          "cycle that incumbents struggle to match because their business models depend on scarcity").split()
+SYLLABLES = ("ka", "zo", "ri", "mu", "ten", "vor", "lex", "qui", "bar", "nel", "dro", "fis", "gu", "hal", "ost", "yen")
+
+
+def codename(rng, used):
+    """A made-up word, so each article holds a fact no other article mentions"""
+    while True:
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(5)).capitalize()
+        if name not in used:
+            used.add(name)
+            return name
+
+
+def sentence(rng, company, concept, num_words=18):
+    words = [rng.choice(FILLER) for _ in range(num_words)]
+    words[rng.randrange(num_words)] = company
+    return f"{' '.join(words).capitalize()} and {concept.lower()}."
+
+
+def article_markdown(rng, title, company, concept, fact, num_sections):
+    lines = [f"# {title}", "", " ".join(sentence(rng, company, concept) for _ in range(4)), ""]
+    fact_section = rng.randrange(num_sections)
+    for section in range(num_sections):
+        lines += [f"## {rng.choice(CONCEPTS)} at {company}", ""]
+        for _ in range(rng.randint(2, 4)):
+            lines += [" ".join(sentence(rng, company, concept) for _ in range(rng.randint(3, 6))), ""]
+        if section == fact_section:
+            lines += [fact, ""]
+    lines += ["* * *", "", "This Update will be available as a podcast later today."]
+    return "\n".join(lines)
+
+
+def generate_corpus(num_articles, output_dir, seed=0):
+    """Writes data.json, the article markdown files under data/, and queries.json. Returns the articles"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(output_dir, 'data'), exist_ok=True)
+    articles, queries, titles, codenames = [], [], set(), set()
+    for i in range(num_articles):
+        company, other = rng.sample(COMPANIES, 2)
+        concept = rng.choice(CONCEPTS)
+        if rng.random() < 0.2:
+            title = f"An Interview with {rng.choice(INTERVIEW_GUESTS)} About {company} and {concept}"
+        else:
+            title = rng.choice(TITLE_TEMPLATES).format(company=company, other=other, concept=concept)
+        if title in titles:
+            title = f"{title}, Part {i}"
+        titles.add(title)
+
+        name = codename(rng, codenames)
+        fact = f"{company}'s {name} initiative is the clearest example of {concept.lower()} in practice."
+        published = LATEST_PUBLISH_DATE - timedelta(days=i * min(1.0, MAX_CORPUS_DAYS / num_articles))
+        slug = '-'.join(title.lower().replace("'", "").replace(",", "").split())
+        article = {
+            'title': title,
+            'public_url': f"https://stratechery.com/{published.year}/{slug}/",
+            'publish_date': published.strftime(PUBLISH_DATE_FORMAT),
+            'file_location': f"./data/{title}.md",
+            'summary': f"In \"{title},\" Ben Thompson examines {company} through the lens of {concept.lower()}, "
+                       f"contrasting it with {other}. " + sentence(rng, company, concept, 30),
+        }
+        with open(os.path.join(output_dir, article['file_location']), 'w') as file:
+            file.write(article_markdown(rng, title, company, concept, fact, rng.randint(3, 7)))
+        articles.append(article)
+        queries.append({'query': f"What is {company}'s {name} initiative?", 'title': title})
+
+    with open(os.path.join(output_dir, 'data.json'), 'w') as file:
+        json.dump(articles, file)
+    with open(os.path.join(output_dir, 'queries.json'), 'w') as file:
+        json.dump(queries, file)
+    return articles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, default=67)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_corpus(args.articles, args.output, args.seed)
+    print(f"Wrote {args.articles} articles to {args.output}")
@@ -0,0 +1,27 @@
+import zlib
+import numpy as np
+
+from lexical_index import tokenize
+from vector_index import EMBEDDING_DIM
+
+
+class HashingEmbeddingFunction:
+    """An offline stand-in for all-MiniLM-L6-v2: a signed feature hash of the text's words. It needs no model
+    download and is fast, so benchmarks measure the pipeline around the embedder rather than the model itself"""
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+
+    def __call__(self, texts):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            hashes = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokenize(text)), dtype=np.uint32)
+            signs = np.where(hashes >> 31, 1.0, -1.0).astype(np.float32)
+            np.add.at(embeddings[i], hashes % self.dim, signs)
+        return embeddings
+
+
+def use_hashing_embedder(dim=EMBEDDING_DIM):
+    """Makes vector_index embed with the hashing stand-in for the rest of the process"""
+    import vector_index
+    vector_index._embedding_function = HashingEmbeddingFunction(dim)
@@ -0,0 +1,162 @@
+"""A local stand-in for the OpenAI chat completions API, for offline benchmarks
+
+Run it on its own with `python benchmarks/fake_openai.py --port 8001` and point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:8001/v1, or start it in-process with start_fake_openai().
+"""
+import argparse
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+WORDS = ("Ben argues that aggregators win by owning demand while suppliers commoditize so the platform captures "
+         "most of the value and integration matters more as the market matures").split()
+
+
+class FakeOpenAIConfig:
+    """How the fake server behaves: latency before the first token, streaming rate, and answer lengths"""
+
+    def __init__(self, first_token_latency=0.3, tokens_per_second=60.0, answer_tokens=120, summary_tokens=80,
+                 tool_calls=True):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.summary_tokens = summary_tokens
+        self.tool_calls = tool_calls  # ask for article chunks whenever tools are offered on a new question
+
+
+class FakeOpenAIStats:
+    def __init__(self):
+        self.requests = 0
+        self.streamed_requests = 0
+        self.tool_call_responses = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+
+    def start(self, stream):
+        with self.lock:
+            self.requests += 1
+            self.streamed_requests += int(bool(stream))
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finish(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def to_dict(self):
+        with self.lock:
+            return {'requests': self.requests, 'streamed_requests': self.streamed_requests,
+                    'tool_call_responses': self.tool_call_responses, 'peak_in_flight': self.peak_in_flight}
+
+
+def estimate_prompt_tokens(messages):
+    return sum(len(json.dumps(message.get('content') or message.get('tool_calls') or '')) for message in messages) // 4
+
+
+def quoted_titles(text):
+    """The articles a question names in quotes, e.g. Summarize "Aggregator's AI Risk", as the model would pick"""
+    return re.findall(r'"([^"]+)"', text)[:3]
+
+
+def plan_response(body, config):
+    """Returns (content words, tool call or None) for a request"""
+    messages = body['messages']
+    if body.get('tools') and config.tool_calls and messages[-1]['role'] == 'user':
+        arguments = json.dumps({"articles": quoted_titles(messages[-1]['content'])})
+        return [], {"index": 0, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                    "function": {"name": "fetch_article_chunks_for_rag", "arguments": arguments}}
+    num_tokens = config.answer_tokens if body.get('tools') or messages[-1]['role'] == 'tool' else config.summary_tokens
+    return [WORDS[i % len(WORDS)] + " " for i in range(num_tokens)], None
+
+
+def chunk_event(completion_id, model, delta=None, finish_reason=None, usage=None):
+    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+             "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]}
+    if usage:
+        chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+async def chat_completions(request):
+    body = await request.json()
+    config, stats = request.app.state.config, request.app.state.stats
+    model = body.get('model', 'gpt-3.5-turbo')
+    words, tool_call = plan_response(body, config)
+    if tool_call:
+        with stats.lock:
+            stats.tool_call_responses += 1
+    usage = {"prompt_tokens": estimate_prompt_tokens(body['messages']), "completion_tokens": max(len(words), 1),
+             "total_tokens": estimate_prompt_tokens(body['messages']) + max(len(words), 1)}
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    stats.start(body.get('stream'))
+
+    if not body.get('stream'):
+        try:
+            await asyncio.sleep(config.first_token_latency + len(words) / config.tokens_per_second)
+        finally:
+            stats.finish()
+        message = {"role": "assistant", "content": "".join(words) or None}
+        if tool_call:
+            message["tool_calls"] = [{key: value for key, value in tool_call.items() if key != "index"}]
+        return JSONResponse({"id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                             "model": model, "usage": usage,
+                             "choices": [{"index": 0, "message": message,
+                                          "finish_reason": "tool_calls" if tool_call else "stop"}]})
+
+    async def events():
+        try:
+            await asyncio.sleep(config.first_token_latency)
+            yield chunk_event(completion_id, model, {"role": "assistant", "content": ""})
+            if tool_call:
+                yield chunk_event(completion_id, model, {"tool_calls": [tool_call]})
+            for word in words:
+                yield chunk_event(completion_id, model, {"content": word})
+                await asyncio.sleep(1.0 / config.tokens_per_second)
+            yield chunk_event(completion_id, model, finish_reason="tool_calls" if tool_call else "stop")
+            if (body.get('stream_options') or {}).get('include_usage'):
+                yield chunk_event(completion_id, model, usage=usage)
+            yield "data: [DONE]\n\n"
+        finally:
+            stats.finish()
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def create_app(config=None):
+    app = Starlette(routes=[Route("/v1/chat/completions", chat_completions, methods=["POST"])])
+    app.state.config = config or FakeOpenAIConfig()
+    app.state.stats = FakeOpenAIStats()
+    return app
+
+
+def start_fake_openai(config=None, host='127.0.0.1', port=0):
+    """Serves the fake API on a background thread. Returns the app (for its stats) and the base URL"""
+    app = create_app(config)
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='warning', access_log=False))
+    threading.Thread(target=server.run, name="fake-openai", daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return app, f"http://{host}:{port}/v1"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=60.0)
+    parser.add_argument('--answer-tokens', type=int, default=120)
+    parser.add_argument('--no-tool-calls', action='store_true')
+    args = parser.parse_args()
+    uvicorn.run(create_app(FakeOpenAIConfig(args.first_token_latency, args.tokens_per_second, args.answer_tokens,
+                                            tool_calls=not args.no_tool_calls)),
+                host='127.0.0.1', port=args.port, log_level='warning')
@@ -0,0 +1,283 @@
+"""Runs the offline end-to-end benchmarks and writes machine-readable results
+
+    python benchmarks/run.py --articles 67 --output results.json
+    python benchmarks/run.py --articles 100000 --workdir /tmp/corpus-100k --scenarios retrieval
+
+Everything runs against a synthetic corpus in a scratch directory and a local fake OpenAI server, so no network
+access or API key is needed. Embeddings use a hashing stand-in unless --embedder minilm is given.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT)
+
+from corpus import generate_corpus  # noqa: E402
+from fake_openai import FakeOpenAIConfig, start_fake_openai  # noqa: E402
+
+SCENARIOS = ('ingestion', 'summarization', 'retrieval', 'ttft', 'concurrency')
+TOKENIZED_SCENARIOS = {'ttft', 'concurrency'}  # these count context tokens with tiktoken
+RETRIEVAL_MODES = {
+    'vector': {'hybrid': False, 'hierarchical': False},
+    'hybrid': {'hybrid': True, 'hierarchical': False},
+    'hierarchical': {'hybrid': True, 'hierarchical': True},
+}
+
+
+def latency_summary(seconds):
+    """Returns the count, mean, and p50/p95/p99 in milliseconds of a list of durations"""
+    if not seconds:
+        return {'count': 0}
+    milliseconds = 1000 * np.asarray(seconds)
+    return {'count': len(seconds), 'mean_ms': float(milliseconds.mean()),
+            **{f"p{q}_ms": float(np.percentile(milliseconds, q)) for q in (50, 95, 99)}}
+
+
+def prepare_workspace(args):
+    """Generates the corpus in the work directory unless one of the same size and seed is already there"""
+    marker_path = os.path.join(args.workdir, 'corpus.json')
+    corpus = {'articles': args.articles, 'seed': args.seed}
+    if os.path.exists(marker_path):
+        with open(marker_path, 'r') as file:
+            if json.load(file) == corpus:
+                return False
+        for name in ('index', 'data', 'summary_cache', 'manifest.db'):
+            path = os.path.join(args.workdir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+    start = time.perf_counter()
+    generate_corpus(args.articles, args.workdir, args.seed)
+    print(f"Generated {args.articles} articles in {time.perf_counter() - start:.1f}s")
+    with open(marker_path, 'w') as file:
+        json.dump(corpus, file)
+    return True
+
+
+def check_token_encoding(model):
+    """Exits with instructions if tiktoken can't load the model's encoding. tiktoken downloads encodings on first use,
+    so without a cached copy a run would fail partway through, or quietly depend on the network"""
+    from context_packer import get_encoder
+    try:
+        get_encoder(model)
+    except Exception as error:
+        sys.exit(f"tiktoken couldn't load the encoding for {model}: {error.__class__.__name__}. Cache it once with "
+                 f"network access, e.g. TIKTOKEN_CACHE_DIR=~/.cache/tiktoken python -c \"import tiktoken; "
+                 f"tiktoken.get_encoding('cl100k_base')\", then run the benchmarks with the same TIKTOKEN_CACHE_DIR")
+
+
+def load_queries(args):
+    with open('queries.json', 'r') as file:
+        queries = json.load(file)
+    return random.Random(args.seed).sample(queries, min(args.queries, len(queries)))
+
+
+def run_ingestion(args):
+    """Chunks and embeds every article with data.chunk_and_embed_articles_from_json, then embeds the summaries"""
+    import chromadb
+    import data
+    from vector_index import get_article_index, get_vector_index
+
+    data.CHROMA_COLLECTION = chromadb.EphemeralClient().get_or_create_collection("benchmark")
+    with open('data.json', 'r') as file:
+        articles = json.load(file)
+
+    start = time.perf_counter()
+    num_chunks = data.chunk_and_embed_articles_from_json('data.json', args.batch_size)
+    chunk_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    data.embed_article_summaries(articles)
+    summary_seconds = time.perf_counter() - start
+    return {
+        'articles': len(articles),
+        'chunks': num_chunks,
+        'chunk_seconds': chunk_seconds,
+        'chunks_per_second': num_chunks / max(chunk_seconds, 1e-9),
+        'summary_seconds': summary_seconds,
+        'index_rows': len(get_vector_index()),
+        'article_index_rows': len(get_article_index()),
+    }
+
+
+def run_summarization(args):
+    """Summarizes articles with summarize.summarize_article against the fake server, from a cold summary cache"""
+    import data
+    import summarize
+
+    shutil.rmtree(summarize.SUMMARY_CACHE_DIR, ignore_errors=True)
+    with open('data.json', 'r') as file:
+        articles = json.load(file)[:args.summary_articles]
+
+    def summarize_one(article):
+        with open(article['file_location'], 'r') as file:
+            return summarize.summarize_article(article['title'], file.read())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=data.SUMMARY_MAX_WORKERS) as executor:
+        list(executor.map(summarize_one, articles))
+    seconds = time.perf_counter() - start
+    return {'articles': len(articles), 'seconds': seconds, 'articles_per_second': len(articles) / max(seconds, 1e-9)}
+
+
+def run_retrieval(args):
+    """Times chatbot_helper.query_articles per retrieval mode, and measures how often the one article holding the
+    answer is among the retrieved chunks"""
+    from chatbot_helper import RETRIEVAL_N_RESULTS, query_articles
+
+    queries = load_queries(args)
+    results = {}
+    for mode, options in RETRIEVAL_MODES.items():
+        query_articles(queries[0]['query'], **options)  # first-use loading isn't part of the latency
+        latencies, hits = [], 0
+        for query in queries:
+            start = time.perf_counter()
+            result = query_articles(query['query'], **options)
+            latencies.append(time.perf_counter() - start)
+            hits += any(metadata['title'] == query['title'] for metadata in result['metadatas'][0])
+        results[mode] = {**latency_summary(latencies), f'recall@{RETRIEVAL_N_RESULTS}': hits / len(queries)}
+    return results
+
+
+def answer(query_text, openai_model):
+    """Runs one opening turn through create_chat_completion_with_rag. Returns (time to first token, total time)"""
+    from chatbot_helper import SYSTEM_MESSAGE, create_chat_completion_with_rag
+
+    start = time.perf_counter()
+    first_token = None
+    for _ in create_chat_completion_with_rag(query_text, [{"role": "system", "content": SYSTEM_MESSAGE}],
+                                             openai_model, use_cache=False):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+    return first_token, time.perf_counter() - start
+
+
+def run_ttft(args):
+    """Answers queries one at a time and times the first token and the full answer"""
+    first_tokens, totals = [], []
+    for query in load_queries(args)[:args.chat_queries]:
+        first_token, total = answer(query['query'], args.model)
+        first_tokens.append(first_token)
+        totals.append(total)
+    return {'time_to_first_token': latency_summary(first_tokens), 'total': latency_summary(totals)}
+
+
+def run_concurrency(args):
+    """Runs many sessions at once, each asking several questions, as Streamlit's per-session threads would"""
+    from llm_client import SchedulerBusy
+
+    queries = load_queries(args)
+    results = {}
+    for sessions in args.sessions:
+        first_tokens, totals, rejected = [], [], []
+
+        def session(session_index):
+            for turn in range(args.turns_per_session):
+                query = queries[(session_index * args.turns_per_session + turn) % len(queries)]
+                try:
+                    first_token, total = answer(query['query'], args.model)
+                except SchedulerBusy:
+                    rejected.append(query)
+                    continue
+                first_tokens.append(first_token)
+                totals.append(total)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            list(executor.map(session, range(sessions)))
+        seconds = time.perf_counter() - start
+        results[str(sessions)] = {'turns_per_second': len(totals) / max(seconds, 1e-9), 'rejected': len(rejected),
+                                  'time_to_first_token': latency_summary(first_tokens),
+                                  'total': latency_summary(totals)}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--articles', type=int, default=67)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="reuse a corpus and its indexes across runs (default: a temp directory)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--embedder', choices=('hashing', 'minilm'), default='hashing')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--summary-articles', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--chat-queries', type=int, default=20)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--turns-per-session', type=int, default=3)
+    parser.add_argument('--model', default='gpt-3.5-turbo')
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--tokens-per-second', type=float, default=60.0)
+    args = parser.parse_args()
+
+    if TOKENIZED_SCENARIOS & set(args.scenarios):
+        check_token_encoding(args.model)
+    output_path = os.path.abspath(args.output) if args.output else None
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='rag-benchmark-'))
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)  # the app keeps data.json, index/, and its caches relative to the working directory
+    prepare_workspace(args)
+
+    fake_openai, base_url = start_fake_openai(FakeOpenAIConfig(args.first_token_latency, args.tokens_per_second))
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ['OPENAI_API_KEY'] = 'benchmark'
+    os.environ.setdefault('METRICS_FILE', os.path.join(args.workdir, 'metrics.jsonl'))
+    if args.embedder == 'hashing':
+        from embedder import use_hashing_embedder
+        use_hashing_embedder()
+
+    from vector_index import get_vector_index
+    scenarios = list(args.scenarios)
+    if len(get_vector_index()) == 0 and 'ingestion' not in scenarios and \
+            set(scenarios) & {'retrieval', 'ttft', 'concurrency'}:
+        scenarios.insert(0, 'ingestion')  # the other scenarios need an index
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        print(f"Running {scenario}...")
+        start = time.perf_counter()
+        results['scenarios'][scenario] = globals()[f"run_{scenario}"](args)
+        print(f"{scenario} finished in {time.perf_counter() - start:.1f}s: "
+              f"{json.dumps(results['scenarios'][scenario])}")
+
+    from instrumentation import METRICS
+    results['stages'] = METRICS.rollups()
+    results['counters'] = dict(METRICS.totals)
+    results['fake_openai'] = fake_openai.state.stats.to_dict()
+    if output_path:
+        with open(output_path, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Wrote results to {output_path}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Measures cold start: run from the repo root with `python benchmarks/startup.py`
+
+Each phase runs in a fresh interpreter, so module imports, data.json parsing, index loading, and the embedding
+model load are all paid again, as they are in a new container.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = {
+    # Everything Streamlit pays for before the first rerun can render
+    'import': "import chatbot_helper",
+    # Catalog, vector/lexical indexes, and the embedding model, which the first query would otherwise wait on
+    'warm_up': "import chatbot_helper; chatbot_helper.warm_up()",
+    # Retrieval for one query on a cold process (no OpenAI call)
+    'first_retrieval': "import chatbot_helper; chatbot_helper.fetch_article_chunks_from_query_search('Who is Ben Thompson?')",
+}
+
+
+def benchmark_env():
+    env = dict(os.environ)
+    env.setdefault('OPENAI_API_KEY', 'startup-benchmark')  # nothing calls OpenAI, but the client requires a key
+    return env
+
+
+def time_phase(code, repeats):
+    """Returns the wall-clock seconds of each fresh-interpreter run of the code"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=benchmark_env(), check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def slowest_imports(limit=15):
+    """Returns chatbot_helper's direct imports with the largest cumulative import time, from `python -X importtime`"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PHASES['import']], cwd=ROOT,
+                            env=benchmark_env(), capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2  # nested imports are indented under their importer
+        if depth == 1:
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    for phase, code in PHASES.items():
+        timings = time_phase(code, args.repeats)
+        results[phase] = {'min_seconds': min(timings), 'mean_seconds': sum(timings) / len(timings)}
+        print(f"{phase}: min {min(timings):.2f}s, mean {results[phase]['mean_seconds']:.2f}s")
+    results['slowest_imports'] = [{'module': name, 'seconds': seconds} for seconds, name in slowest_imports()]
+    for entry in results['slowest_imports']:
+        print(f"  {entry['seconds']:.3f}s {entry['module']}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
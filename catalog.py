@@ -0,0 +1,163 @@
+import difflib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+CATALOG_FILE = 'data.json'
+PUBLISH_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
+DISPLAY_DATE_FORMAT = "%b %d, %Y"
+SEARCH_DATE_FORMAT = "%Y-%m-%d"
+RELOAD_CHECK_INTERVAL = 1.0  # seconds between mtime checks of the catalog file
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def parse_search_date(value, name):
+    try:
+        if not isinstance(value, str):
+            raise ValueError
+        return datetime.strptime(value, SEARCH_DATE_FORMAT).date()
+    except ValueError:
+        raise ValueError(f"{name} must be a date formatted as YYYY-MM-DD, got {value!r}") from None
+
+
+def normalize_title(title):
+    """Lowercases a title and strips punctuation, curly quotes, and extra whitespace"""
+    title = title.lower().replace('’', "'").replace('‘', "'").replace('“', '"').replace('”', '"')
+    return ' '.join(re.sub(r"[^\w\s]", ' ', title).split())
+
+
+class ArticleCatalog:
+    """The articles in data.json, indexed by title and URL, reloaded only when the file changes"""
+
+    def __init__(self, json_file_name=CATALOG_FILE):
+        self.json_file_name = json_file_name
+        self.articles = []
+        self.by_title = {}
+        self.by_url = {}
+        self.by_normalized_title = {}
+        self.title_index = {}  # normalized title word -> indexes of the articles with that word in their title
+        self.version = None
+        self._stat = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    def reload_if_changed(self, force=False):
+        """Re-reads the catalog file if its mtime/size changed and its content hash differs"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < RELOAD_CHECK_INTERVAL:
+            return False
+        with self._lock:
+            self._checked_at = now
+            stat = os.stat(self.json_file_name)
+            stat_key = (stat.st_mtime_ns, stat.st_size)
+            if not force and stat_key == self._stat:
+                return False
+            self._stat = stat_key
+            with open(self.json_file_name, 'rb') as file:
+                raw = file.read()
+            version = hashlib.sha256(raw).hexdigest()
+            if version == self.version:
+                return False
+            self._build(json.loads(raw))
+            self.version = version
+            return True
+
+    def _build(self, articles):
+        for article in articles:
+            article['published'] = datetime.strptime(article['publish_date'], PUBLISH_DATE_FORMAT)
+            article['display_date'] = article['published'].strftime(DISPLAY_DATE_FORMAT)
+        self.by_title = {article['title']: article for article in articles}
+        self.by_url = {article['public_url']: article for article in articles}
+        self.by_normalized_title = {normalize_title(article['title']): article for article in articles}
+        title_index = {}
+        for i, article in enumerate(articles):
+            for word in set(normalize_title(article['title']).split()):
+                title_index.setdefault(word, set()).add(i)
+        self.title_index = title_index
+        self.articles = articles
+
+    def __len__(self):
+        self.reload_if_changed()
+        return len(self.articles)
+
+    def get_by_url(self, url):
+        self.reload_if_changed()
+        return self.by_url.get(url)
+
+    def match_title(self, title, cutoff=0.8):
+        """Returns the article whose title best matches `title`, or None if nothing is close enough"""
+        self.reload_if_changed()
+        if title in self.by_title:
+            return self.by_title[title]
+        normalized = normalize_title(title)
+        if normalized in self.by_normalized_title:
+            return self.by_normalized_title[normalized]
+        matches = difflib.get_close_matches(normalized, self.by_normalized_title.keys(), n=1, cutoff=cutoff)
+        return self.by_normalized_title[matches[0]] if matches else None
+
+    def search_titles(self, keywords=None, start_date=None, end_date=None, limit=20):
+        """Returns the most recent articles whose titles contain every keyword (prefix matches count) and whose
+        publish date falls within [start_date, end_date], given as YYYY-MM-DD strings. Raises ValueError for
+        keywords that aren't a string or list of strings, or a date in any other format"""
+        self.reload_if_changed()
+        if isinstance(keywords, list) and all(isinstance(keyword, str) for keyword in keywords):
+            keywords = ' '.join(keywords)
+        elif keywords is not None and not isinstance(keywords, str):
+            raise ValueError(f"keywords must be a string or a list of strings, got {keywords!r}")
+        indexes = None
+        for word in normalize_title(keywords or '').split():
+            matches = set().union(*(self.title_index[key] for key in self.title_index if key.startswith(word)))
+            indexes = matches if indexes is None else indexes & matches
+        indexes = range(len(self.articles)) if indexes is None else sorted(indexes)
+
+        start = parse_search_date(start_date, 'start_date') if start_date else None
+        end = parse_search_date(end_date, 'end_date') if end_date else None
+        results = []
+        for i in indexes:
+            article = self.articles[i]
+            published = article['published'].date()
+            if (start and published < start) or (end and published > end):
+                continue
+            results.append({'title': article['title'], 'publish_date': article['display_date'],
+                            'url': article['public_url']})
+            if len(results) >= limit:
+                break
+        return results
+
+    @property
+    def titles(self):
+        self.reload_if_changed()
+        return [article['title'] for article in self.articles]
+
+    @property
+    def most_recent(self):
+        self.reload_if_changed()
+        return self.articles[0]
+
+    @property
+    def oldest(self):
+        self.reload_if_changed()
+        return self.articles[-1]
+
+    def formatted_list(self):
+        """Returns numbered "Title (Mon DD, YYYY)" lines, most recent first"""
+        self.reload_if_changed()
+        return [f"{i + 1}. {article['title']} ({article['display_date']})" for i, article in enumerate(self.articles)]
+
+
+def get_catalog(json_file_name=CATALOG_FILE):
+    """Returns the process-wide ArticleCatalog for the given file, building it on first use"""
+    catalog = _catalogs.get(json_file_name)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(json_file_name)
+            if catalog is None:
+                catalog = _catalogs[json_file_name] = ArticleCatalog(json_file_name)
+    return catalog
@@ -1,11 +1,15 @@
-import random
-import time
 import streamlit as st
+import json
+import os
+import threading
+import openai
+import requests
 from chatbot_helper import (SYSTEM_MESSAGE, NUM_ARTICLES, MOST_RECENT_ARTICLE_TITLE, MOST_RECENT_ARTICLE_DATE,
-                            MOST_RECENT_ARTICLE_URL, create_chat_completion_with_rag)
-from openai import OpenAI
-import weave 
-weave.init('stratechery-chatbot')
+                            MOST_RECENT_ARTICLE_URL, create_chat_completion_with_rag,
+                            warm_semantic_cache, warm_up)
+from history import ConversationHistory
+from llm_client import SchedulerBusy
+from tracing import init_tracing
 
 st.set_page_config(
     page_title="Stratechery Chatbot",
@@ -14,9 +18,49 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-with open("styles/styles.css") as css:
-    css_content = css.read()
-    st.markdown(f"<style>{css_content}</style>", unsafe_allow_html=True)
+
+@st.cache_data
+def load_styles():
+    with open("styles/styles.css") as css:
+        return css.read()
+
+
+st.markdown(f"<style>{load_styles()}</style>", unsafe_allow_html=True)
+
+SUGGESTED_QUESTIONS = [
+    "What does Ben think of the Vision Pro?",
+    "Provide the key points in Stratechery's analysis of Microsoft's acquisition of Activision Blizzard",
+    "What is Disney's strategy moving forward?",
+    f"Summarize \"{MOST_RECENT_ARTICLE_TITLE}\""
+]
+
+
+@st.cache_resource
+def start_tracing():
+    """Starts weave tracing once per process rather than on every rerun"""
+    return init_tracing()
+
+
+def warm_up_and_cache_answers():
+    warm_up()
+    warm_semantic_cache(SUGGESTED_QUESTIONS, 'gpt-3.5-turbo')
+
+
+@st.cache_resource
+def start_warmup():
+    """Loads the indexes and embedding model, then answers the suggested questions, in the background once per
+    process so sessions never wait on them"""
+    thread = threading.Thread(target=warm_up_and_cache_answers, daemon=True)
+    thread.start()
+    return thread
+
+
+# Set to the URL of a running api.py service to make this app a thin client of it, e.g. http://localhost:8000
+CHATBOT_API_URL = os.getenv('CHATBOT_API_URL')
+
+if not CHATBOT_API_URL:
+    start_tracing()
+    start_warmup()
 
 if "messages" not in st.session_state:
     st.session_state.messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
@@ -26,7 +70,9 @@ APP_DESCRIPTION = f"""
 - It is *not* approved by Ben Thompson or any Stratechery affiliates.
 """
 
-openai_client = OpenAI()
+if "history" not in st.session_state:
+    st.session_state.history = ConversationHistory()
+
 with st.sidebar:
     gpt_model = st.selectbox('Select a Model', ('gpt-3.5-turbo', 'gpt-4-turbo-preview'))
     st.divider()
@@ -65,26 +111,47 @@ st.title("Ben Thompson Stratechery Chatbot")
 st.caption(f"_Ask me anything about Stratechery! I'm have knowledge on the {NUM_ARTICLES} most recent articles._")
 
 
+def stream_chat_from_api(prompt, messages, model):
+    """Streams an answer from the /chat endpoint of api.py, reading its Server-Sent Events"""
+    body = {"query": prompt, "model": model, "conversation_id": st.session_state.get("conversation_id"),
+            "messages": [message for message in messages if message["role"] != "system"]}
+    with requests.post(f"{CHATBOT_API_URL}/chat", json=body, stream=True, timeout=(5, 120)) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "conversation":
+                    st.session_state.conversation_id = data["conversation_id"]
+                elif event == "error":
+                    raise RuntimeError(data["error"])
+                elif "delta" in data:
+                    yield data["delta"]
+            elif not line:
+                event = None
+
+
 def add_message_and_respond(prompt):
+    if CHATBOT_API_URL:
+        answer = stream_chat_from_api(prompt, list(st.session_state.messages), gpt_model)
+    else:
+        # create_chat_completion_with_rag appends the prompt itself, so build the chain from the messages before it
+        message_chain = st.session_state.history.build_messages(SYSTEM_MESSAGE, st.session_state.messages)
+        answer = create_chat_completion_with_rag(prompt, message_chain, gpt_model)
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.markdown(prompt)
     with st.chat_message("assistant"):
-        with st.spinner(""):
-            stream = create_chat_completion_with_rag(prompt,
-                                                     [{"role": msg["role"], "content": msg["content"]} for msg in
-                                                      st.session_state.messages],
-                                                     gpt_model)
-        if type(stream) is str:
-            def stream_data():
-                for word in stream.split():
-                    yield word + " "
-                    time.sleep(random.uniform(0.01, 0.03))
-
-            st.write_stream(stream_data())
-            response = stream
-        else:
-            response = st.write_stream(stream)
+        try:
+            response = st.write_stream(answer)
+        except (SchedulerBusy, openai.APIError, requests.RequestException) as error:
+            print(f"Couldn't answer {prompt!r}: {error!r}")
+            st.warning("The chatbot is busy right now, please retry in a moment.")
+            # Drop the unanswered question, so the history never holds a question without its answer
+            st.session_state.messages.pop()
+            return
     st.session_state.messages.append({"role": "assistant", "content": response})
 
 
@@ -92,12 +159,7 @@ button_container = st.empty()
 button_string = ""
 with button_container:
     col1, col2 = st.columns(2, gap="small")
-    questions = [
-        "What does Ben think of the Vision Pro?",
-        "Provide the key points in Stratechery's analysis of Microsoft's acquisition of Activision Blizzard",
-        "What is Disney's strategy moving forward?",
-        f"Summarize \"{MOST_RECENT_ARTICLE_TITLE}\""
-    ]
+    questions = SUGGESTED_QUESTIONS
     with col1:
         if st.button(questions[0], use_container_width=True):
             button_string = questions[0]
@@ -1,12 +1,20 @@
-from pprint import pprint
 import dotenv
 import os
 import json
-from openai import OpenAI
-from langsmith.run_helpers import traceable
-import requests
-from datetime import datetime
-import weave
+import asyncio
+import contextvars
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+import instrumentation
+from llm_client import BACKGROUND, INTERACTIVE, achat_completion, chat_completion
+from catalog import get_catalog
+from context_packer import CONTEXT_TOKEN_BUDGETS, DEFAULT_CONTEXT_TOKEN_BUDGET, pack_context
+from diversify import EXPANSION_TOKEN_SHARE, MMR_CANDIDATES, expand_to_passages, maximal_marginal_relevance
+from semantic_cache import SEMANTIC_CACHE
+from lexical_index import get_lexical_index
+from embedding_service import embed_query, get_embedding_service
+from vector_index import get_article_index, get_vector_index
 
 dotenv.load_dotenv()
 
@@ -16,70 +24,133 @@ if os.getenv('IS_CLOUD') == 'true':
     sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-openai_client = OpenAI()
-
-# import chromadb
-# chroma_client = chromadb.PersistentClient('./chroma.db')
-
-
-def query_articles(query_text, n_results=7):
-    q = {
-        'documents': [
-            [
-                "Document 1 text", 
-                "Document 2 text", 
-                "Document 3 text", 
-                "Document 4 text", 
-                "Document 5 text", 
-                "Document 6 text", 
-                "Document 7 text"
-            ]
-        ],
-        'distances': [
-            [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7] # Example distances, assuming lower means more relevant
-        ],
-        'metadatas': [
-            [
-            {"title": "Title 1", "author": "Author 1", "year": 2021, "url": "https://example.com/document1"},
-            {"title": "Title 2", "author": "Author 2", "year": 2022, "url": "https://example.com/document2"},
-            {"title": "Title 3", "author": "Author 3", "year": 2023, "url": "https://example.com/document3"},
-            {"title": "Title 4", "author": "Author 4", "year": 2024, "url": "https://example.com/document4"},
-            {"title": "Title 5", "author": "Author 5", "year": 2025, "url": "https://example.com/document5"},
-            {"title": "Title 6", "author": "Author 6", "year": 2026, "url": "https://example.com/document6"},
-            {"title": "Title 7", "author": "Author 7", "year": 2027, "url": "https://example.com/document7"}
-        ]
-        ],
-        'ids': [
-            ["1", "2", "3", "4", "5", "6", "7"] # Example IDs
-        ]
-    }
-    return q
+
+# Runs tool-call retrieval while the first completion is still streaming
+RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+
+def submit_retrieval(function, *args, **kwargs):
+    """Runs a function on the retrieval executor, keeping the current turn so its spans are recorded"""
+    return RETRIEVAL_EXECUTOR.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+RETRIEVAL_N_RESULTS = 5
+HYBRID_CANDIDATES = 20  # candidates taken from each of the vector and BM25 indexes before fusion
+RRF_K = 60
+FILTERED_LEXICAL_OVERFETCH = 5  # BM25 candidates are filtered by title after scoring, so fetch more of them
+# Two-stage retrieval: pick articles by summary similarity, then search only their chunks
+HIERARCHICAL_RETRIEVAL = True
+HIERARCHICAL_TOP_ARTICLES = 5
+HIERARCHICAL_LEXICAL_ARTICLES = 3  # articles of the best BM25 hits are searched too, for names embeddings miss
+
+MAX_TOOL_ROUNDS = 3  # title lookups the model may make before it has to answer
+TOOL_CALL_MODEL = "gpt-3.5-turbo"  # decides which articles to fetch; the chosen model only writes the answer
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """Fuses ranked lists of ids, scoring each id by the sum of 1 / (k + rank) across the lists"""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+_unsummarized_titles = (None, None, [])  # (chunk title_rows, summary title_rows, titles) of the last lookup
+
+
+def unsummarized_titles(vector_index, article_index):
+    """Returns the titles of articles that have chunks but no summary row, e.g. because ingestion stopped between
+    the two. Cached until either index changes, which replaces its title_rows"""
+    global _unsummarized_titles
+    chunk_title_rows, summary_title_rows, titles = _unsummarized_titles
+    if chunk_title_rows is not vector_index.title_rows or summary_title_rows is not article_index.title_rows:
+        titles = [title for title in vector_index.title_rows if title not in article_index.title_rows]
+        _unsummarized_titles = (vector_index.title_rows, article_index.title_rows, titles)
+    return titles
+
+
+def find_relevant_articles(query_embedding, lexical_ids=()):
+    """Returns the titles of the articles whose summaries are most similar to the query, plus the articles of the
+    best BM25 hits and any article without a summary, or None if article summaries haven't been embedded yet"""
+    article_index = get_article_index()
+    if len(article_index) == 0:
+        return None
+    rows, _ = article_index.search(query_embedding, HIERARCHICAL_TOP_ARTICLES)
+    article_titles = [article_index.metadatas[row]['title'] for row in rows]
+    vector_index = get_vector_index()
+    for chunk_id in lexical_ids[:HIERARCHICAL_LEXICAL_ARTICLES]:
+        if chunk_id in vector_index.id_to_row:
+            article_titles.append(vector_index.metadatas[vector_index.id_to_row[chunk_id]]['title'])
+    article_titles.extend(unsummarized_titles(vector_index, article_index))
+    return list(dict.fromkeys(article_titles))
+
+
+def query_articles(query_text, n_results=RETRIEVAL_N_RESULTS, hybrid=True, article_titles=None,
+                   hierarchical=HIERARCHICAL_RETRIEVAL, query_embedding=None):
+    """Embeds the query and returns the n_results most relevant article chunks. With hybrid retrieval, vector and
+    BM25 candidates are fused with reciprocal rank fusion, so exact names the embeddings miss still surface.
+    If article titles are given, only their chunks are searched, falling back to the whole corpus to fill any
+    remaining slots. Otherwise, hierarchical retrieval first picks the articles by summary similarity"""
+    if query_embedding is None:
+        with instrumentation.span('query_embedding'):
+            query_embedding = embed_query(query_text)
+    vector_index = get_vector_index()
+    with instrumentation.span('lexical_search'):
+        lexical_ids = get_lexical_index().search(query_text, HYBRID_CANDIDATES * FILTERED_LEXICAL_OVERFETCH)[0] \
+            if hybrid else []
+
+    with instrumentation.span('vector_search'):
+        if article_titles is None and hierarchical:
+            article_titles = find_relevant_articles(query_embedding, lexical_ids)
+        title_rows = vector_index.rows_for_titles(article_titles) if article_titles is not None else None
+        rows, distances = vector_index.search(query_embedding, HYBRID_CANDIDATES if hybrid else n_results,
+                                              rows=title_rows)
+    if hybrid:
+        if title_rows is not None:
+            allowed_titles = set(article_titles)
+            lexical_ids = [chunk_id for chunk_id in lexical_ids if chunk_id in vector_index.id_to_row and
+                           vector_index.metadatas[vector_index.id_to_row[chunk_id]]['title'] in allowed_titles]
+        fused_ids = reciprocal_rank_fusion([vector_index.ids[row] for row in rows], lexical_ids[:HYBRID_CANDIDATES])
+        rows = np.array([vector_index.id_to_row[chunk_id] for chunk_id in fused_ids
+                         if chunk_id in vector_index.id_to_row][:n_results], dtype=np.int64)
+        distances = 1.0 - vector_index.embeddings[rows] @ query_embedding
+
+    if title_rows is not None and len(rows) < n_results:
+        rows, distances = fill_from_global_search(vector_index, query_embedding, rows, distances, n_results)
+    return vector_index.to_query_result(rows, distances)
+
+
+def fill_from_global_search(vector_index, query_embedding, rows, distances, n_results):
+    """Tops up a title-filtered result with the nearest chunks from the whole corpus"""
+    global_rows, global_distances = vector_index.search(query_embedding, n_results + len(rows))
+    seen = set(rows.tolist())
+    extra = [i for i, row in enumerate(global_rows) if row not in seen][:n_results - len(rows)]
+    return (np.concatenate([rows, global_rows[extra]]).astype(np.int64),
+            np.concatenate([distances, global_distances[extra]]))
 
 
 def get_articles_info_from_json(json_file_name):
-    with open(json_file_name, 'r') as file:
-        articles = json.load(file)
-    articles_format = []
-    article_titles = [article['title'] for article in articles]
-    for i, article in enumerate(articles):
-        article['publish_date'] = datetime.strptime(article['publish_date'], "%a, %d %b %Y %H:%M:%S %z").strftime("%b %d, %Y")
-        articles_format.append(f"{i+1}. {article['title']} ({article['publish_date']})")
-    most_recent_article_title = articles[0]['title']
-    most_recent_article_date = articles[0]['publish_date']
-    most_recent_article_url = articles[0]['public_url']
-    oldest_article_date = articles[-1]['publish_date']
-    return (len(articles), articles_format, article_titles,
-            most_recent_article_title, most_recent_article_date, most_recent_article_url, oldest_article_date)
+    catalog = get_catalog(json_file_name)
+    most_recent_article = catalog.most_recent
+    return (len(catalog), catalog.formatted_list(), catalog.titles,
+            most_recent_article['title'], most_recent_article['display_date'], most_recent_article['public_url'],
+            catalog.oldest['display_date'])
 
 
 (NUM_ARTICLES, ARTICLES_FORMAT, ARTICLE_TITLES,
  MOST_RECENT_ARTICLE_TITLE, MOST_RECENT_ARTICLE_DATE, MOST_RECENT_ARTICLE_URL, OLDEST_ARTICLE_DATE) = get_articles_info_from_json('data.json')
 
 
-SYSTEM_MESSAGE = f"""* You are a bot that knows everything about Ben Thompson's Stratechery articles (https://stratechery.com/). 
+# Above this many articles the catalog is no longer inlined into the prompt and tool schema. The model looks titles
+# up with the search_article_titles tool instead, so the prompt stays a fixed-size, cacheable prefix. Each inlined
+# article costs ~35 tokens (its title and date in the prompt, its title again in the enum), so 100 articles already
+# add ~3.5k tokens to every request, more than gpt-3.5-turbo's whole retrieved-context budget
+INLINE_CATALOG_MAX_ARTICLES = 100
+INLINE_CATALOG = NUM_ARTICLES <= INLINE_CATALOG_MAX_ARTICLES
+
+STATIC_SYSTEM_MESSAGE = """* You are a bot that knows everything about Ben Thompson's Stratechery articles (https://stratechery.com/). 
 * You are smart, witty, and love tech! You talk candidly and casually.
-* You are trained on the {NUM_ARTICLES} most recent Stratechery articles. The oldest article is {OLDEST_ARTICLE_DATE}. 
-* Here are their names and publish dates from most recent to oldest: {ARTICLES_FORMAT}
 * You will answer questions using Stratechery articles. You will always respond in markdown. You will always refer to the specific name of the article you are citing and hyperlink to its url, as such: [Article Title](Article URL).
 * If you are referring to Ben Thompson, just say "Ben". If you can't answer, you will explain why and suggest sending the question to email@sharptech.fm where Ben can answer it directly!
 * A user's questions may be followed by a bunch of possible answers from Stratechery articles. Each article is is separated by `-----` and is formatted as such: `[Article Title](Article URL)\\n[Chunk of Article Content]`. Use your best judgement to answer the user's query based on the articles provided.
@@ -89,6 +160,17 @@ SYSTEM_MESSAGE = f"""* You are a bot that knows everything about Ben Thompson's
 * Ben Wallace (https://ben-wallace.replit.app/) created you. Your code can be found at https://github.com/benfwalla/BenThompsonChatbot. You are not approved by Ben Thompson.
 """
 
+if INLINE_CATALOG:
+    CATALOG_SYSTEM_MESSAGE = f"""* You are trained on the {NUM_ARTICLES} most recent Stratechery articles. The oldest article is {OLDEST_ARTICLE_DATE}. 
+* Here are their names and publish dates from most recent to oldest: {ARTICLES_FORMAT}
+"""
+else:
+    CATALOG_SYSTEM_MESSAGE = f"""* You are trained on the {NUM_ARTICLES} most recent Stratechery articles. The oldest article is {OLDEST_ARTICLE_DATE}. The most recent is {MOST_RECENT_ARTICLE_TITLE} ({MOST_RECENT_ARTICLE_DATE}).
+* Use the search_article_titles function to look up article titles and publish dates by keyword or date range before asking for articles by name.
+"""
+
+SYSTEM_MESSAGE = STATIC_SYSTEM_MESSAGE + CATALOG_SYSTEM_MESSAGE
+
 TOOLS = [
     {
         "type": "function",
@@ -101,10 +183,7 @@ TOOLS = [
                 "properties": {
                   "articles": {
                     "type": "array",
-                    "items": {
-                        "type": "string",
-                        "enum": ARTICLE_TITLES
-                    },
+                    "items": {"type": "string", "enum": ARTICLE_TITLES} if INLINE_CATALOG else {"type": "string"},
                     "description": "A list of articles you think is most relevant to the given query from your system message. Provide no more than the top 3 most likely and recent (e.g. ['Aggregator's AI Risk', 'An Interview with Nat Friedman and Daniel Gross Reasoning About AI']).",
                   }
                 },
@@ -114,112 +193,406 @@ TOOLS = [
     }
 ]
 
-
-@weave.op()
-def call_openai(messages, model="gpt-3.5-turbo"):
-    return openai_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        tools=TOOLS
-    )
+if not INLINE_CATALOG:
+    TOOLS.append({
+        "type": "function",
+        "function": {
+            "name": "search_article_titles",
+            "description": "Searches the titles and publish dates of the Stratechery articles you know, most recent first. "
+                           "Use it to find the exact titles to pass to fetch_article_chunks_for_rag.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "keywords": {"type": "string", "description": "Words that must appear in the title (e.g. 'Apple Vision')."},
+                    "start_date": {"type": "string", "description": "Earliest publish date, as YYYY-MM-DD."},
+                    "end_date": {"type": "string", "description": "Latest publish date, as YYYY-MM-DD."},
+                },
+            },
+        }
+    })
+
+
+SEARCH_TITLE_ARGUMENTS = ('keywords', 'start_date', 'end_date')
+
+
+def search_article_titles(keywords=None, start_date=None, end_date=None):
+    """Answers a search_article_titles tool call from the catalog's title index"""
+    with instrumentation.span('catalog_lookup'):
+        return get_catalog().search_titles(keywords, start_date, end_date)
+
+
+@tracing.op
+def call_openai(messages, model=TOOL_CALL_MODEL, stream=False, priority=INTERACTIVE):
+    return chat_completion(model, messages, tools=TOOLS, stream=stream, priority=priority)
+
+
+def accumulate_tool_call_deltas(tool_calls, deltas):
+    """Merges streamed tool-call deltas into complete tool calls, keyed by their index"""
+    for delta in deltas:
+        tool_call = tool_calls.setdefault(delta.index, {"id": None, "type": "function",
+                                                        "function": {"name": "", "arguments": ""}})
+        if delta.id:
+            tool_call["id"] = delta.id
+        if delta.function and delta.function.name:
+            tool_call["function"]["name"] += delta.function.name
+        if delta.function and delta.function.arguments:
+            tool_call["function"]["arguments"] += delta.function.arguments
+    return tool_calls
+
+
+def stream_content(stream):
+    """Yields the text deltas of a streamed chat completion"""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def arguments_complete(tool_call):
+    """Whether a streamed tool call's arguments have been received in full, i.e. parse as JSON"""
+    try:
+        json.loads(tool_call["function"]["arguments"])
+    except ValueError:
+        return False
+    return True
+
+
+class ToolCallRound:
+    """Collects the tool calls of one streamed completion. Each fetch_article_chunks_for_rag call's retrieval starts
+    as soon as its arguments are complete, while the rest of the stream is read: a search within the articles it
+    names, or the global search if it names none we know"""
+
+    def __init__(self, query_text, openai_model):
+        self.query_text = query_text
+        self.token_budget = context_token_budget(openai_model)
+        self.tool_calls = {}  # index -> tool call
+        self.retrievals = {}  # tool call id -> (article summaries, Future of their chunks, None if none matched)
+        self.global_chunks = None
+
+    def add_deltas(self, deltas):
+        accumulate_tool_call_deltas(self.tool_calls, deltas)
+        rag_calls = [tool_call for tool_call in self.tool_calls.values()
+                     if tool_call["function"]["name"] == "fetch_article_chunks_for_rag"]
+        for tool_call in rag_calls:
+            if tool_call["id"] in self.retrievals or not arguments_complete(tool_call):
+                continue
+            # The budget is split between the calls seen so far; packing enforces the final split
+            token_budget = self.token_budget // len(rag_calls)
+            try:
+                article_summaries, chunks = start_retrieval_for_tool_call(self.query_text, tool_call, token_budget)
+            except ValueError:
+                continue  # answer_tool_calls reports the bad arguments
+            if chunks is None and self.global_chunks is None:
+                self.global_chunks = submit_retrieval(fetch_article_chunks_from_query_search, self.query_text,
+                                                      token_budget=token_budget)
+            self.retrievals[tool_call["id"]] = (article_summaries, chunks)
+
+    def completed_tool_calls(self):
+        return [self.tool_calls[index] for index in sorted(self.tool_calls)]
 
 
 def fetch_article_summaries(articles_to_summarize, json_file_name='data.json'):
-    """Returns a list of dicts with article titles, summaries, and URLs"""
-    with open(json_file_name, 'r') as file:
-        articles = json.load(file)
-
-    summaries = []
-    for article_title in articles_to_summarize:
-        article_dict = next(item for item in articles if item["title"] == article_title)
-        summaries.append({
-            "title": article_title,
-            "summary": article_dict["summary"],
-            "url": article_dict["public_url"]
-        })
+    """Returns a list of dicts with article titles, summaries, and URLs. Titles that don't match an article are skipped"""
+    with instrumentation.span('catalog_lookup'):
+        catalog = get_catalog(json_file_name)
+
+        summaries = []
+        for article_title in articles_to_summarize:
+            article_dict = catalog.match_title(article_title)
+            if article_dict is None:
+                continue
+            summaries.append({
+                "title": article_dict["title"],
+                "summary": article_dict.get("summary", ""),
+                "url": article_dict["public_url"]
+            })
 
     return summaries
 
 
-def fetch_article_chunks_from_query_search(query_text):
-    """Returns an organized list of article chunks from a given query"""
-    q = query_articles(query_text, n_results=7)
-
-    documents = q['documents'][0]
-    distances = q['distances'][0]
-    metadatas = q['metadatas'][0]
-    ids = q['ids'][0]
-
-    combined = list(zip(distances, documents, metadatas, ids))
-    combined.sort(key=lambda x: x[0])
-
-    grouped_chunks = {}
-    for distance, document, metadata, article_id in combined:
-        article_title = metadata['title']
-        if article_title not in grouped_chunks:
-            grouped_chunks[article_title] = {'url': metadata['url'], 'documents': []}
-        grouped_chunks[article_title]['documents'].append(document)
-
-    return grouped_chunks
-
-
-def combine_summaries_and_chunks(summaries, chunks):
-    """Combines article summaries and chunks into a single string"""
-    result = []
-    for summary in summaries:
-        title = summary['title']
-        result.append(f"[{title}]({summary['url']})")
-        result.append(f"Summary: {summary['summary']}")
-        if title in chunks:
-            result.extend(chunks[title]['documents'])
-            del chunks[title]  # Remove the article from chunks to avoid duplication
-        result.append("-----")
-
-    # Append any remaining chunks that didn't have a summary
-    for title, info in chunks.items():
-        result.append(f"[{title}]({info['url']})")
-        result.extend(info['documents'])
-        result.append("-----")
-
-    return "\n".join(result).strip("-----\n")
-
-
-@weave.op()
-def create_chat_completion_with_rag(query_text, message_chain, openai_model):
-    message_chain.append({"role": "user", "content": query_text})
-
-    completion = call_openai(message_chain)
-    response_message = completion.choices[0].message
-    tool_calls = response_message.tool_calls
-    print("\n\n")
-    print(tool_calls)
-    if tool_calls and tool_calls[0].function.name == "fetch_article_chunks_for_rag":
-        if 'articles' in tool_calls[0].function.arguments:
-            article_titles = json.loads(tool_calls[0].function.arguments)['articles']
-            article_summaries = fetch_article_summaries(article_titles)
-        else:
-            article_summaries = []
-
-        article_chunks = fetch_article_chunks_from_query_search(query_text)
-        combined_content = combine_summaries_and_chunks(article_summaries, article_chunks)
-
-        message_chain.append(response_message)
-        message_chain.append(
-            {
-                "tool_call_id": tool_calls[0].id,
-                "role": "tool",
-                "name": "fetch_article_chunks_for_rag",
-                "content": combined_content,
-            }
-        )
-        second_response = openai_client.chat.completions.create(
-            model=openai_model,
-            messages=message_chain,
-            stream=True
-        )
-        return second_response
-    else:
-        return completion.choices[0].message.content
+def fetch_article_chunks_from_query_search(query_text, article_titles=None, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """Returns the query's most relevant, mutually distinct article chunks grouped by article, optionally restricted
+    to some articles. Candidates are over-fetched and picked with maximal marginal relevance, then adjacent chunks
+    of an article are merged into one passage, grown with their neighbours while they fit the token budget"""
+    with instrumentation.span('query_embedding'):
+        query_embedding = embed_query(query_text)
+    q = query_articles(query_text, n_results=MMR_CANDIDATES, article_titles=article_titles,
+                       query_embedding=query_embedding)
+
+    with instrumentation.span('diversification'):
+        vector_index = get_vector_index()
+        rows = np.array([vector_index.id_to_row[chunk_id] for chunk_id in q['ids'][0]], dtype=np.int64)
+        distances = np.asarray(q['distances'][0], dtype=np.float32)
+        picked = maximal_marginal_relevance(query_embedding, vector_index.embeddings[rows],
+                                            RETRIEVAL_N_RESULTS)
+        return expand_to_passages(vector_index, rows[picked], distances[picked],
+                                  int(token_budget * EXPANSION_TOKEN_SHARE))
+
+
+def context_token_budget(openai_model):
+    return CONTEXT_TOKEN_BUDGETS.get(openai_model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+
+class RagTurn:
+    """The tool-call rounds of one answer, shared by the sync and async streams, which only differ in how they call
+    OpenAI. The model may look up titles for up to MAX_TOOL_ROUNDS rounds; once it asks for articles, or the rounds
+    run out, it answers with openai_model"""
+
+    def __init__(self, query_text, message_chain, openai_model):
+        message_chain.append({"role": "user", "content": query_text})
+        self.query_text = query_text
+        self.message_chain = message_chain
+        self.openai_model = openai_model
+        self.num_rounds = 0
+        self.tool_round = None
+        self.answered = False  # the model answered without calling tools
+        self.retrieving = False  # the last round asked for article chunks
+
+    def next_round(self):
+        """Starts a round and returns True while the model may still call tools"""
+        if self.answered or self.retrieving or self.num_rounds == MAX_TOOL_ROUNDS:
+            return False
+        self.num_rounds += 1
+        self.tool_round = ToolCallRound(self.query_text, self.openai_model)
+        return True
+
+    def read_chunk(self, chunk):
+        """Collects a streamed chunk's tool calls and returns its text, if any"""
+        if not chunk.choices:
+            return None
+        delta = chunk.choices[0].delta
+        if delta.tool_calls:
+            self.tool_round.add_deltas(delta.tool_calls)
+        return delta.content
+
+    def finish_round(self):
+        tool_calls = self.tool_round.completed_tool_calls()
+        instrumentation.count('tool_calls', len(tool_calls))
+        if not tool_calls:
+            self.answered = True
+            return
+        self.message_chain.append({"role": "assistant", "content": None, "tool_calls": tool_calls})
+        if any(tool_call["function"]["name"] == "fetch_article_chunks_for_rag" for tool_call in tool_calls):
+            self.retrieving = True
+            return
+        # The model is looking up titles: answer from the catalog and let it continue
+        for tool_call in tool_calls:
+            self.message_chain.append(answer_search_tool_call(tool_call))
+
+    def add_retrieved_context(self):
+        """Answers the final round's tool calls, waiting for their retrieval"""
+        tool_round = self.tool_round
+        self.message_chain.extend(answer_tool_calls(self.query_text, tool_round.completed_tool_calls(),
+                                                    self.openai_model, tool_round.retrievals,
+                                                    tool_round.global_chunks))
+
+    def answer_arguments(self):
+        """Extra arguments of the final completion. If every round went to title lookups, the model has to answer
+        from what it found"""
+        return {} if self.retrieving else {"tools": TOOLS, "tool_choice": "none"}
+
+
+def stream_chat_completion_with_rag(query_text, message_chain, openai_model, priority=INTERACTIVE):
+    """Streams the answer to a query as text deltas. Direct answers are forwarded as they arrive; if the model asks
+    for articles, chunk retrieval starts as soon as the tool call's arguments are complete, while the rest of the
+    stream is read"""
+    turn = RagTurn(query_text, message_chain, openai_model)
+    while turn.next_round():
+        with instrumentation.span('first_llm_call'):
+            for chunk in call_openai(message_chain, model=TOOL_CALL_MODEL, stream=True, priority=priority):
+                text = turn.read_chunk(chunk)
+                if text:
+                    yield text
+        turn.finish_round()
+    if turn.answered:
+        return
+
+    if turn.retrieving:
+        turn.add_retrieved_context()
+    with instrumentation.span('completion'):
+        yield from stream_content(chat_completion(openai_model, message_chain, priority=priority, stream=True,
+                                                  **turn.answer_arguments()))
+
+
+def answer_tool_calls(query_text, tool_calls, openai_model, retrievals=None, global_chunks=None):
+    """Returns a tool message for every tool call in the final round. Article retrievals run concurrently and
+    split the context token budget; calls that name no known article share the global search. Retrievals already
+    started while the tool calls streamed are reused"""
+    rag_calls = [tool_call for tool_call in tool_calls if tool_call["function"]["name"] == "fetch_article_chunks_for_rag"]
+    token_budget = context_token_budget(openai_model) // len(rag_calls)
+    retrievals = dict(retrievals or {})
+    for tool_call in rag_calls:
+        if tool_call["id"] not in retrievals:
+            try:
+                retrievals[tool_call["id"]] = start_retrieval_for_tool_call(query_text, tool_call, token_budget)
+            except ValueError as error:
+                retrievals[tool_call["id"]] = error
+
+    tool_messages = []
+    for tool_call in tool_calls:
+        if tool_call["function"]["name"] != "fetch_article_chunks_for_rag":
+            tool_messages.append(answer_search_tool_call(tool_call))
+            continue
+        if isinstance(retrievals[tool_call["id"]], ValueError):
+            tool_messages.append(tool_message(tool_call, json.dumps({"error": str(retrievals[tool_call["id"]])})))
+            continue
+        article_summaries, article_chunks = retrievals[tool_call["id"]]
+        if article_chunks is None:
+            if global_chunks is None:
+                global_chunks = submit_retrieval(fetch_article_chunks_from_query_search, query_text,
+                                                 token_budget=token_budget)
+            article_chunks = global_chunks
+        article_chunks = article_chunks.result()
+        with instrumentation.span('context_packing'):
+            combined_content, context_tokens = pack_context(article_summaries, article_chunks, openai_model,
+                                                            token_budget)
+        instrumentation.count('context_tokens', context_tokens)
+        tool_messages.append(tool_message(tool_call, combined_content))
+    return tool_messages
+
+
+def tool_message(tool_call, content):
+    return {
+        "tool_call_id": tool_call["id"],
+        "role": "tool",
+        "name": tool_call["function"]["name"],
+        "content": content,
+    }
+
+
+def answer_search_tool_call(tool_call):
+    """Answers a search_article_titles tool call with a tool message. Arguments the catalog can't use are answered
+    with an error, so the model can correct them and search again"""
+    try:
+        arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        if not isinstance(arguments, dict):
+            raise ValueError("arguments must be a JSON object")
+        unknown = sorted(set(arguments) - set(SEARCH_TITLE_ARGUMENTS))
+        if unknown:
+            raise ValueError(f"unknown arguments {unknown}, expected some of {list(SEARCH_TITLE_ARGUMENTS)}")
+        content = search_article_titles(**arguments)
+    except ValueError as error:
+        content = {"error": str(error)}
+    return tool_message(tool_call, json.dumps(content))
+
+
+def start_retrieval_for_tool_call(query_text, tool_call, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """Matches the articles a fetch_article_chunks_for_rag call named and starts searching the query's chunks
+    within them. Returns their summaries and a Future of the chunks, which is None if no named article matched,
+    so the global search is used instead. Raises ValueError for arguments that aren't a list of titles"""
+    arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+    articles = arguments.get('articles', []) if isinstance(arguments, dict) else None
+    if not isinstance(articles, list) or not all(isinstance(title, str) for title in articles):
+        raise ValueError("arguments must be a JSON object whose 'articles' is a list of article titles")
+    article_summaries = fetch_article_summaries(articles)
+    if not article_summaries:
+        return article_summaries, None
+    article_titles = [summary['title'] for summary in article_summaries]
+    return article_summaries, submit_retrieval(fetch_article_chunks_from_query_search, query_text, article_titles,
+                                               token_budget=token_budget)
+
+
+def get_corpus_version():
+    """Returns a version string that changes whenever new articles are ingested"""
+    return get_catalog().version
+
+
+@tracing.op
+def create_chat_completion_with_rag(query_text, message_chain, openai_model, use_cache=True, priority=INTERACTIVE):
+    """Streams the answer to a query. Opening questions are served from the semantic cache when a near-identical
+    question was already answered by the same model over the same corpus"""
+    with instrumentation.turn(openai_model):
+        cacheable = use_cache and not any(message['role'] in ('user', 'assistant') for message in message_chain)
+        if cacheable:
+            query_embedding = embed_query(query_text)
+            corpus_version = get_corpus_version()
+            cached_answer = SEMANTIC_CACHE.lookup(query_embedding, openai_model, corpus_version)
+            instrumentation.count('semantic_cache_hits' if cached_answer is not None else 'semantic_cache_misses')
+            if cached_answer is not None:
+                message_chain.append({"role": "user", "content": query_text})
+                instrumentation.mark_first_token()
+                yield cached_answer
+                return
+
+        answer = []
+        for text in stream_chat_completion_with_rag(query_text, message_chain, openai_model, priority):
+            if not answer:
+                instrumentation.mark_first_token()
+            answer.append(text)
+            yield text
+
+        if cacheable and answer:
+            SEMANTIC_CACHE.store(query_embedding, openai_model, corpus_version, ''.join(answer))
+
+
+def warm_semantic_cache(questions, openai_model):
+    """Answers each question once so later askers are served from the semantic cache. The answers are background
+    work, so they never take slots from users waiting on theirs"""
+    for question in questions:
+        for _ in create_chat_completion_with_rag(question, [{"role": "system", "content": SYSTEM_MESSAGE}],
+                                                 openai_model, priority=BACKGROUND):
+            pass
+
+
+def warm_up():
+    """Loads the catalog, indexes, and embedding model so the first query doesn't pay for them"""
+    get_catalog()
+    get_vector_index()
+    get_article_index()
+    get_lexical_index()
+    embed_query("Who is Ben Thompson?")
+
+
+async def astream_chat_completion_with_rag(query_text, message_chain, openai_model, priority=INTERACTIVE):
+    """The asyncio version of stream_chat_completion_with_rag, for the headless API. OpenAI streams are read with
+    the shared async client; retrieval and context packing run on worker threads"""
+    turn = RagTurn(query_text, message_chain, openai_model)
+    while turn.next_round():
+        with instrumentation.span('first_llm_call'):
+            stream = await achat_completion(TOOL_CALL_MODEL, message_chain, priority=priority, tools=TOOLS,
+                                            stream=True)
+            async for chunk in stream:
+                text = turn.read_chunk(chunk)
+                if text:
+                    yield text
+        turn.finish_round()
+    if turn.answered:
+        return
+
+    if turn.retrieving:
+        await asyncio.to_thread(turn.add_retrieved_context)
+    with instrumentation.span('completion'):
+        stream = await achat_completion(openai_model, message_chain, priority=priority, stream=True,
+                                        **turn.answer_arguments())
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def acreate_chat_completion_with_rag(query_text, message_chain, openai_model, use_cache=True,
+                                           priority=INTERACTIVE):
+    """The asyncio version of create_chat_completion_with_rag, sharing its semantic cache"""
+    with instrumentation.turn(openai_model):
+        cacheable = use_cache and not any(message['role'] in ('user', 'assistant') for message in message_chain)
+        if cacheable:
+            query_embedding = await asyncio.wrap_future(get_embedding_service().submit(query_text))
+            corpus_version = get_corpus_version()
+            cached_answer = SEMANTIC_CACHE.lookup(query_embedding, openai_model, corpus_version)
+            instrumentation.count('semantic_cache_hits' if cached_answer is not None else 'semantic_cache_misses')
+            if cached_answer is not None:
+                message_chain.append({"role": "user", "content": query_text})
+                instrumentation.mark_first_token()
+                yield cached_answer
+                return
+
+        answer = []
+        async for text in astream_chat_completion_with_rag(query_text, message_chain, openai_model, priority):
+            if not answer:
+                instrumentation.mark_first_token()
+            answer.append(text)
+            yield text
+
+        if cacheable and answer:
+            SEMANTIC_CACHE.store(query_embedding, openai_model, corpus_version, ''.join(answer))
 
 
 if __name__ == '__main__':
@@ -227,6 +600,6 @@ if __name__ == '__main__':
         {'role': 'system', 'content': SYSTEM_MESSAGE}
     ]
 
-    print(create_chat_completion_with_rag("Who is Ben Thompson?", test_messages, 'gpt-3.5-turbo'))
-    print(create_chat_completion_with_rag("What does Ben think about the Apple Vision Pro?", test_messages, 'gpt-3.5-turbo'))
+    print(''.join(create_chat_completion_with_rag("Who is Ben Thompson?", test_messages, 'gpt-3.5-turbo')))
+    print(''.join(create_chat_completion_with_rag("What does Ben think about the Apple Vision Pro?", test_messages, 'gpt-3.5-turbo')))
     print(fetch_article_summaries(["Aggregator's AI Risk", "An Interview with Nat Friedman and Daniel Gross Reasoning About AI"]))
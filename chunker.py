@@ -0,0 +1,121 @@
+import re
+from collections import deque
+from typing import NamedTuple
+
+CHUNK_SIZE = 1000  # characters, or tokens when a length function is given
+CHUNK_OVERLAP = 0
+
+# A heading line, or a paragraph: consecutive non-blank lines that aren't headings
+BLOCK_PATTERN = re.compile(r"^(?P<heading>#{1,6}[ \t]+(?P<title>[^\n]*?))[ \t#]*$"
+                           r"|(?P<paragraph>(?:^(?!#{1,6}[ \t])[ \t]*\S[^\n]*(?:\n|\Z))+)", re.MULTILINE)
+# The whitespace after a sentence's end, so closing quotes and brackets stay with the sentence they close
+SENTENCE_BREAK_PATTERN = re.compile(r"(?:(?<=[.!?])|(?<=[.!?][\"'”’)\]])|(?<=[.!?][\"'”’)\]]{2}))\s+")
+WORD_BREAK_PATTERN = re.compile(r"\s+")
+
+
+class ChunkSpan(NamedTuple):
+    """A chunk of an article, as character offsets into its markdown and the heading of its section"""
+    article_id: str
+    start: int
+    end: int
+    header: str
+
+    def text(self, markdown):
+        return markdown[self.start:self.end]
+
+
+def iter_blocks(markdown):
+    """Yields (start, end, heading title or None) for each heading line and paragraph, in one pass"""
+    for match in BLOCK_PATTERN.finditer(markdown):
+        if match.group('heading') is not None:
+            yield match.start(), match.end('heading'), match.group('title').strip()
+        else:
+            start, end = match.span()
+            while end > start and markdown[end - 1].isspace():
+                end -= 1
+            yield start, end, None
+
+
+def split_range(markdown, start, end, pattern):
+    """Yields the (start, end) pieces of a range split after each match of the pattern"""
+    for match in pattern.finditer(markdown, start, end):
+        if match.start() > start:
+            yield start, match.start()
+        start = match.end()
+    if start < end:
+        yield start, end
+
+
+def iter_pieces(markdown, start, end, chunk_size, measure, sentences=False):
+    """Yields (start, end, size) pieces of a block no bigger than chunk_size: the whole block if it fits (unless
+    sentences are asked for), else its sentences, else groups of words. A single word longer than a chunk is cut"""
+    if not sentences:
+        size = measure(start, end)
+        if size <= chunk_size:
+            yield start, end, size
+            return
+    for sentence_start, sentence_end in split_range(markdown, start, end, SENTENCE_BREAK_PATTERN):
+        sentence_size = measure(sentence_start, sentence_end)
+        if sentence_size <= chunk_size:
+            yield sentence_start, sentence_end, sentence_size
+            continue
+        piece_start = piece_end = None
+        for word_start, word_end in split_range(markdown, sentence_start, sentence_end, WORD_BREAK_PATTERN):
+            while measure(word_start, word_end) > chunk_size:
+                cut = word_start + max(1, (word_end - word_start) * chunk_size // measure(word_start, word_end))
+                if piece_start is not None:
+                    yield piece_start, piece_end, measure(piece_start, piece_end)
+                    piece_start = None
+                yield word_start, cut, measure(word_start, cut)
+                word_start = cut
+            if piece_start is not None and measure(piece_start, word_end) > chunk_size:
+                yield piece_start, piece_end, measure(piece_start, piece_end)
+                piece_start = None
+            if piece_start is None:
+                piece_start = word_start
+            piece_end = word_end
+        if piece_start is not None:
+            yield piece_start, piece_end, measure(piece_start, piece_end)
+
+
+def iter_chunk_spans(markdown, article_id, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=None):
+    """Splits markdown into ChunkSpans of up to chunk_size in a single pass. Chunks never cross a heading, break
+    between paragraphs where they can and between sentences where they must, and repeat up to chunk_overlap of the
+    previous chunk's trailing sentences. Overlap is made of whole sentences, so with overlap chunks break between
+    sentences rather than paragraphs. Sizes are characters, or length_function(text) (e.g. a token count)"""
+    if length_function is None:
+        def measure(start, end):
+            return end - start
+    else:
+        def measure(start, end):
+            return length_function(markdown[start:end])
+
+    def size_with(pieces, extra=None):
+        """The size of the chunk the pieces (plus an extra piece) would make"""
+        if not pieces:
+            return extra[2] if extra else 0
+        if length_function is None:
+            return (extra[1] if extra else pieces[-1][1]) - pieces[0][0]
+        return sum(piece[2] for piece in pieces) + (extra[2] if extra else 0)
+
+    header = ''
+    pieces = deque()  # (start, end, size) of the chunk being built
+    has_content = False  # whether the chunk holds more than headings
+    for block_start, block_end, heading in iter_blocks(markdown):
+        if heading is not None:
+            if has_content:
+                yield ChunkSpan(article_id, pieces[0][0], pieces[-1][1], header)
+                pieces.clear()
+                has_content = False
+            header = heading
+        for piece in iter_pieces(markdown, block_start, block_end, chunk_size, measure,
+                                 sentences=chunk_overlap > 0 and heading is None):
+            # A section's headings always stay with its first content, even if that overflows the chunk
+            if has_content and size_with(pieces, piece) > chunk_size:
+                yield ChunkSpan(article_id, pieces[0][0], pieces[-1][1], header)
+                while pieces and (size_with(pieces) > chunk_overlap or size_with(pieces, piece) > chunk_size):
+                    pieces.popleft()
+            pieces.append(piece)
+            has_content = has_content or heading is None
+    if pieces:
+        yield ChunkSpan(article_id, pieces[0][0], pieces[-1][1], header)
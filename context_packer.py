@@ -0,0 +1,81 @@
+import functools
+import re
+
+CONTEXT_TOKEN_BUDGETS = {
+    'gpt-3.5-turbo': 3000,
+    'gpt-4-turbo-preview': 12000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+SEPARATOR = "-----"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model):
+    """Returns the tiktoken encoder for a model, built once per process"""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    return len(get_encoder(model).encode(text, disallowed_special=()))
+
+
+def _normalize(text):
+    return ' '.join(re.sub(r"[^\w\s]", ' ', text.lower()).split())
+
+
+def _is_duplicate(normalized, selected):
+    return any(normalized in other or other in normalized for other in selected)
+
+
+def rank_context(summaries, chunks):
+    """Returns (distance, title, url, text) items, most relevant first. A summary ranks with its article's best
+    chunk, or with the best chunk overall if the model asked for an article retrieval didn't surface"""
+    items = []
+    for title, info in chunks.items():
+        for document, distance in zip(info['documents'], info['distances']):
+            items.append((distance, 1, title, info['url'], document))
+
+    best_distance = min((item[0] for item in items), default=0.0)
+    for summary in summaries:
+        title = summary['title']
+        distance = min(chunks[title]['distances']) if title in chunks else best_distance
+        items.append((distance, 0, title, summary['url'], f"Summary: {summary['summary']}"))
+
+    items.sort(key=lambda item: (item[0], item[1]))
+    return [(distance, title, url, text) for distance, _, title, url, text in items]
+
+
+def pack_context(summaries, chunks, model="gpt-3.5-turbo", token_budget=None):
+    """Packs the most relevant, non-duplicate summaries and chunks into the model's context token budget.
+    Returns the packed content and the number of tokens it uses"""
+    if token_budget is None:
+        token_budget = CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+    articles = {}  # title -> [header, texts...], in order of first selection
+    selected = []
+    tokens_used = 0
+    for distance, title, url, text in rank_context(summaries, chunks):
+        normalized = _normalize(text)
+        if not normalized or _is_duplicate(normalized, selected):
+            continue
+        cost = count_tokens(text, model) + 1
+        if title not in articles:
+            header = f"[{title}]({url})"
+            cost += count_tokens(f"{header}\n{SEPARATOR}", model) + 2
+        if tokens_used + cost > token_budget:
+            continue
+        articles.setdefault(title, [f"[{title}]({url})"]).append(text)
+        selected.append(normalized)
+        tokens_used += cost
+
+    sections = []
+    for lines in articles.values():
+        # Keep each article's summary ahead of its chunks
+        lines[1:] = sorted(lines[1:], key=lambda line: not line.startswith("Summary: "))
+        sections.append("\n".join(lines))
+    content = f"\n{SEPARATOR}\n".join(sections)
+    return content, count_tokens(content, model)
@@ -7,13 +7,28 @@ import warnings
 import urllib.parse
 import feedparser
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
 import chromadb.utils.embedding_functions as embedding_functions
-from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
+from chunker import CHUNK_OVERLAP, CHUNK_SIZE, iter_chunk_spans
+from dedup import drop_near_duplicates, get_duplicate_index
+from lexical_index import get_lexical_index
+from manifest import DONE, IngestionManifest, content_hash
+from quantized_index import build_quantized_index
+from rate_limit import backoff_delays
 from summarize import summarize_article
+from vector_index import EMBEDDING_MODEL, VECTOR_QUANTIZATION, embed_texts, get_article_index, get_vector_index
 
 warnings.filterwarnings("ignore")
 
+EMBEDDING_BATCH_SIZE = 256
+SUMMARY_MAX_WORKERS = 8
+
+
+class ArticleFetchError(Exception):
+    """Raised when an article's markdown can't be fetched"""
+
 
 def get_articles_from_rss(rss_feed_url):
     """Returns a list of dictionaries of articles from a given RSS feed showing their url, title, and publish date"""
@@ -54,6 +69,12 @@ def get_article_as_markdown(article_url, access_token, article_title=None, save_
     """Converts a given article url to markdown and save it to the ./data folder"""
     encoded_url = urllib.parse.quote(article_url + f'?access_token={access_token}')
     response = requests.get(f'https://urltomarkdown.herokuapp.com/?url={encoded_url}&title=true')
+    for delay in backoff_delays():
+        if response.status_code != 429:
+            break
+        print(f"Rate limited fetching {article_title}, retrying in {delay:.1f} seconds...")
+        time.sleep(delay)
+        response = requests.get(f'https://urltomarkdown.herokuapp.com/?url={encoded_url}&title=true')
     if response.status_code == 200:
 
         pprint(article_title)
@@ -76,84 +97,184 @@ def get_article_as_markdown(article_url, access_token, article_title=None, save_
         return
 
 
-def split_article_into_chunks(article_content, article_title, chunk_size=1000):
-    """Splits the given markdown article into digestible chunks and returns them as a list"""
-    markdown_splitter = RecursiveCharacterTextSplitter.from_language(
-        language=Language.MARKDOWN, chunk_size=chunk_size, chunk_overlap=0
-    )
-    chunks = markdown_splitter.create_documents([article_content])
-    chunks_with_ids = [{'chunk_id': f"{i}_{article_title}", 'page_content': chunk.page_content} for i, chunk in
-                       enumerate(chunks)]
-    return chunks_with_ids
+def split_article_into_chunks(article_content, article_title, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """Splits the given markdown article into digestible chunks, yielding each with its offsets and section heading"""
+    for i, span in enumerate(iter_chunk_spans(article_content, article_title, chunk_size, chunk_overlap)):
+        yield {'chunk_id': f"{i}_{article_title}", 'chunk_index': i, 'page_content': span.text(article_content),
+               'start': span.start, 'end': span.end, 'header': span.header}
 
 
-def embed_and_save_in_chroma(chunk_id, article_chunk, article_url, article_title, article_date):
-    """Embeds and saves a given article chunk to Chroma"""
+def embed_and_save_batch_in_chroma(chunks):
+    """Embeds a batch of chunks in one forward pass and saves them to Chroma and the vector index in one upsert"""
+    ids = [chunk['chunk_id'] for chunk in chunks]
+    documents = [chunk['page_content'] for chunk in chunks]
+    metadatas = [chunk['metadata'] for chunk in chunks]
+    embeddings = embed_texts(documents)
     CHROMA_COLLECTION.upsert(
-        ids=[chunk_id],
-        documents=[article_chunk],
-        metadatas=[{"url": article_url, "title": article_title, "date": article_date}],
+        ids=ids,
+        embeddings=embeddings.tolist(),
+        documents=documents,
+        metadatas=metadatas,
     )
+    get_vector_index().upsert(ids, embeddings, documents, metadatas)
+    get_lexical_index().add(ids, documents)
+    return len(ids)
+
+
+def chunk_article(article, markdown_content):
+    """Yields the chunks of an article along with the metadata they are stored with"""
+    metadata = {"url": article['public_url'], "title": article['title'], "date": article['publish_date']}
+    for chunk in split_article_into_chunks(markdown_content, article['title']):
+        chunk['metadata'] = {**metadata, 'chunk_index': chunk['chunk_index'], 'start': chunk['start'],
+                             'end': chunk['end'], 'header': chunk['header']}
+        yield chunk
+
+
+def save_keyword_and_duplicate_indexes():
+    """Writes the BM25 postings and near-duplicate signatures added so far, which otherwise live in memory"""
+    get_lexical_index().save()
+    get_duplicate_index().save()
+
+
+def embed_chunks_in_batches(chunks, batch_size=EMBEDDING_BATCH_SIZE, max_pending_batches=2, on_batch_saved=None):
+    """Groups chunks from any number of articles into batches and embeds them on a background worker,
+    so the next batch is chunked while the current one is embedded. Returns the number of chunks embedded"""
+    start_time = time.perf_counter()
+    num_embedded = 0
+    pending = deque()
+    batch = []
+
+    def wait_for_oldest_batch():
+        nonlocal num_embedded
+        saved_batch, future = pending.popleft()
+        num_embedded += future.result()
+        if on_batch_saved:
+            on_batch_saved(saved_batch)
+        elapsed = time.perf_counter() - start_time
+        print(f"Embedded {num_embedded} chunks ({num_embedded / elapsed:.1f} chunks/sec)")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                if len(pending) >= max_pending_batches:
+                    wait_for_oldest_batch()
+                pending.append((batch, executor.submit(embed_and_save_batch_in_chroma, batch)))
+                batch = []
+        if batch:
+            pending.append((batch, executor.submit(embed_and_save_batch_in_chroma, batch)))
+        while pending:
+            wait_for_oldest_batch()
+    if num_embedded:
+        get_lexical_index().save()
+        if VECTOR_QUANTIZATION:
+            build_quantized_index(get_vector_index(), VECTOR_QUANTIZATION)
+    duplicate_index = get_duplicate_index()
+    if duplicate_index.num_checked:
+        duplicate_index.save()
+        duplicate_index.print_report()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Done! Embedded {num_embedded} chunks in {elapsed:.1f}s ({num_embedded / max(elapsed, 1e-9):.1f} chunks/sec)")
+    return num_embedded
+
+
+def embed_article_summaries(articles):
+    """Embeds each article's title and summary into the article index used for two-stage retrieval"""
+    articles = [article for article in articles if article.get('summary')]
+    for start in range(0, len(articles), EMBEDDING_BATCH_SIZE):
+        batch = articles[start:start + EMBEDDING_BATCH_SIZE]
+        documents = [f"{article['title']}\n{article['summary']}" for article in batch]
+        get_article_index().upsert([article['public_url'] for article in batch],
+                                   embed_texts(documents),
+                                   documents,
+                                   [{"url": article['public_url'], "title": article['title'],
+                                     "date": article['publish_date']} for article in batch])
+    print(f"Embedded {len(articles)} article summaries")
+
+
+def iter_chunks_from_json_articles(articles):
+    """Reads each article's saved markdown and yields its chunks, leaving out near-duplicates of stored chunks"""
+    for i, article in enumerate(articles):
+        print(f"ARTICLE {i + 1}/{len(articles)} - {article['title']}")
+        with open(article['file_location'], 'r') as file:
+            markdown_content = file.read()
+        yield from drop_near_duplicates(chunk_article(article, markdown_content))
+
 
-    return CHROMA_COLLECTION.get(chunk_id, include=["metadatas", "embeddings", "documents"])
+def export_chroma_to_vector_index(batch_size=1000):
+    """Copies every chunk already stored in Chroma into the vector index the chatbot queries"""
+    vector_index = get_vector_index()
+    total = CHROMA_COLLECTION.count()
+    for offset in range(0, total, batch_size):
+        batch = CHROMA_COLLECTION.get(include=["metadatas", "embeddings", "documents"], limit=batch_size, offset=offset)
+        vector_index.upsert(batch['ids'], batch['embeddings'], batch['documents'], batch['metadatas'])
+        get_lexical_index().add(batch['ids'], batch['documents'])
+        get_duplicate_index().add_existing(batch['ids'], batch['documents'], batch['metadatas'])
+        print(f"Exported {min(offset + batch_size, total)}/{total} chunks to {vector_index.index_dir}")
+    get_lexical_index().save()
+    get_duplicate_index().save()
+    return vector_index
 
 
-def chunk_and_embed_one_article_from_json(json_file_name, article_title):
+def chunk_and_embed_one_article_from_json(json_file_name, article_title, batch_size=EMBEDDING_BATCH_SIZE):
     """Chunks and embeds the article in the given JSON file to Chroma"""
     with open(json_file_name, 'r') as file:
         articles = json.load(file)
 
     article = next((article for article in articles if article['title'] == article_title), None)
+    return embed_chunks_in_batches(iter_chunks_from_json_articles([article]), batch_size)
 
-    with open(article['file_location'], 'r') as file:
-        markdown_content = file.read()
-    chunks = split_article_into_chunks(markdown_content, article['title'])
-    for chunk in chunks:
-        print(
-            f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}...")
-        embed_and_save_in_chroma(chunk['chunk_id'],
-                                 chunk['page_content'],
-                                 article['public_url'],
-                                 article['title'],
-                                 article['publish_date']
-                                 )
-    print("Done!")
-
-
-def chunk_and_embed_articles_from_json(file_name):
+
+def chunk_and_embed_articles_from_json(file_name, batch_size=EMBEDDING_BATCH_SIZE):
     """Chunks and embeds the articles in the given JSON file to Chroma"""
     with open(file_name, 'r') as file:
         articles = json.load(file)
 
-    for article in articles:
-        print(f"ARTICLE {articles.index(article)}/{len(articles)} - {article['title']}")
-        with open(article['file_location'], 'r') as file:
-            markdown_content = file.read()
-        chunks = split_article_into_chunks(markdown_content, article['title'])
-        for chunk in chunks:
-            print(
-                f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}...")
-            embed_and_save_in_chroma(chunk['chunk_id'],
-                                     chunk['page_content'],
-                                     article['public_url'],
-                                     article['title'],
-                                     article['publish_date']
-                                     )
-    print("Done!")
-
-
-def summarize_articles_in_json(json_file_name):
+    return embed_chunks_in_batches(iter_chunks_from_json_articles(articles), batch_size)
+
+
+def fetch_and_summarize_article(article, manifest=None):
+    """Fetches an article's markdown and stores its summary on the article. Returns the markdown.
+    If the manifest already holds a summary of identical content, it is reused instead of re-summarized"""
+    markdown_content = get_article_as_markdown(article['public_url'], STRATECHERY_ACCESS_TOKEN, article['title'])
+    if markdown_content is None:
+        raise ArticleFetchError(f"Could not fetch {article['public_url']} as markdown")
+    markdown_hash = content_hash(markdown_content)
+    row = manifest.get(article['public_url']) if manifest else None
+    if row and row['summary_status'] == DONE and row['content_hash'] == markdown_hash:
+        article['summary'] = row['summary']
+        return markdown_content
+
+    article['summary'] = summarize_article(article['title'], markdown_content)
+    if manifest:
+        manifest.record_summary(article, markdown_hash, article['summary'])
+    return markdown_content
+
+
+def fetch_and_summarize_articles(articles, max_workers=SUMMARY_MAX_WORKERS, manifest=None):
+    """Fetches and summarizes articles concurrently, yielding (article, markdown) as each one finishes.
+    Throughput is bounded by the OpenAI rate limiter in summarize.py rather than fixed sleeps. An article that
+    fails is logged and skipped, leaving its manifest stages pending for the next run"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_and_summarize_article, article, manifest): article for article in articles}
+        for i, future in enumerate(as_completed(futures)):
+            article = futures[future]
+            try:
+                markdown_content = future.result()
+            except Exception as error:
+                print(f"({i + 1}/{len(articles)}) - FAILED {article['title']}: {error!r}")
+                continue
+            print(f"({i + 1}/{len(articles)}) - SUMMARIZED {article['title']}")
+            yield article, markdown_content
+
+
+def summarize_articles_in_json(json_file_name, max_workers=SUMMARY_MAX_WORKERS):
     with open(json_file_name, 'r') as file:
         articles = json.load(file)
 
-    for i, article in enumerate(articles):
-        print(f"({i+1}/{len(articles)}) - SUMMARIZING {article['title']}")
-        markdown_content = get_article_as_markdown(article['public_url'], STRATECHERY_ACCESS_TOKEN, article['title'])
-        summary = summarize_article(article['title'], markdown_content)
-        article['summary'] = summary
-        if i % 10 == 0 and i != 0:
-            print("Sleeping for 60 seconds to avoid rate limiting...")
-            time.sleep(60)
+    for _ in fetch_and_summarize_articles(articles, max_workers):
+        pass
 
     with open(json_file_name, 'w') as file:
         json.dump(articles, file, indent=4)
@@ -161,52 +282,105 @@ def summarize_articles_in_json(json_file_name):
     return articles
 
 
-def check_for_latest_articles(rss_feed_url, json_file_name, embed=True):
-    """Returns a list of new articles that do not exist in the ChromaDB"""
-    # Retrieve existing article titles from ChromaDB
-    all_metadatas = CHROMA_COLLECTION.get(include=["metadatas"]).get("metadatas")
-    existing_articles = set([x['title'] for x in all_metadatas])
+def write_json_if_changed(json_file_name, articles):
+    """Atomically rewrites the JSON file, only if its contents would change. Returns True if it was written"""
+    new_contents = json.dumps(articles, indent=4)
+    if os.path.exists(json_file_name):
+        with open(json_file_name, 'r') as file:
+            if file.read() == new_contents:
+                return False
+    tmp_path = f"{json_file_name}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(new_contents)
+    os.replace(tmp_path, json_file_name)
+    return True
 
-    # Fetch the latest RSS feed
-    article_json = fetch_latest_rss_as_json(rss_feed_url)
-    new_articles = []
-
-    # Go through each article in the latest RSS pull and check if their title exists in the ChromaDB
-    for article in article_json:
-        if article['title'] not in existing_articles:
-            print(f"NEW ARTICLE: {article['title']}")
-
-            markdown_content = get_article_as_markdown(article['public_url'],
-                                                       STRATECHERY_ACCESS_TOKEN,
-                                                       article['title'])
-
-            summary = summarize_article(article['title'], markdown_content)
-            article['summary'] = summary
-
-            if embed:
-                chunks = split_article_into_chunks(markdown_content, article['title'])
-                for chunk in chunks:
-                    print(f"({chunk['chunk_id'].split('_')[0]}/{len(chunks) - 1}) {article['title']} - {chunk['page_content'][:50]}...")
-                    embed_and_save_in_chroma(chunk['chunk_id'],
-                                             chunk['page_content'],
-                                             article['public_url'],
-                                             article['title'],
-                                             article['publish_date']
-                                             )
-            new_articles.append(article)
-
-    # Read existing data from the file
+
+def merge_articles_into_json(json_file_name, updated_articles):
+    """Replaces re-ingested articles in the JSON file and prepends new ones, keeping RSS order"""
     with open(json_file_name, 'r') as file:
         all_articles = json.load(file)
 
-    # Append new articles at the beginning of the list
-    all_articles[:0] = new_articles
+    updated_by_url = {article['public_url']: article for article in updated_articles}
+    existing_urls = {article['public_url'] for article in all_articles}
+    all_articles = [updated_by_url.get(article['public_url'], article) for article in all_articles]
+    all_articles[:0] = [article for article in updated_articles if article['public_url'] not in existing_urls]
 
-    # Write all the articles back to the json file
-    with open(json_file_name, 'w') as file:
-        json.dump(all_articles, file, indent=4)
+    return write_json_if_changed(json_file_name, all_articles)
 
-    return new_articles
+
+def check_for_latest_articles(rss_feed_url, json_file_name, embed=True):
+    """Returns a list of new or changed articles, as recorded by the ingestion manifest"""
+    manifest = IngestionManifest()
+    with open(json_file_name, 'r') as file:
+        saved_articles = json.load(file)
+    if len(manifest) == 0:
+        # First run with a manifest: everything already in the JSON file has been ingested
+        manifest.import_articles(saved_articles, EMBEDDING_MODEL)
+
+    # Fetch the latest RSS feed
+    article_json = fetch_latest_rss_as_json(rss_feed_url)
+
+    # Only articles that are new, were interrupted by a crashed run, or need re-embedding are processed. So are
+    # articles a crashed run completed in the manifest but never wrote to the JSON file, which is written last
+    pending_urls = {article['public_url'] for article in manifest.pending(article_json, EMBEDDING_MODEL, embed)}
+    saved_summaries = {article['public_url']: article.get('summary') for article in saved_articles}
+    new_articles = [article for article in article_json if article['public_url'] in pending_urls or
+                    saved_summaries.get(article['public_url']) != manifest.get(article['public_url'])['summary']]
+    for article in new_articles:
+        print(f"NEW ARTICLE: {article['title']}")
+
+    remaining_chunks = {}  # url -> chunks of that article not yet saved
+    articles_by_url = {}
+    ingested_articles = []  # articles that were fetched and summarized, leaving out failures
+
+    def iter_new_article_chunks():
+        for article, markdown_content in fetch_and_summarize_articles(new_articles, manifest=manifest):
+            ingested_articles.append(article)
+            if not embed:
+                continue
+            chunks = list(drop_near_duplicates(chunk_article(article, markdown_content)))
+            chunk_ids = [chunk['chunk_id'] for chunk in chunks]
+            stale_ids = sorted(set(manifest.get(article['public_url'])['chunk_ids']) - set(chunk_ids))
+            if stale_ids:
+                # The embed worker may be upserting earlier articles meanwhile; both indexes lock their writes
+                CHROMA_COLLECTION.delete(ids=stale_ids)
+                get_vector_index().delete(stale_ids)
+                get_lexical_index().delete(stale_ids)
+            manifest.record_chunks(article, chunk_ids)
+            if not chunks:
+                save_keyword_and_duplicate_indexes()
+                embed_article_summaries([article])
+                manifest.record_embedded(article['public_url'], article['title'], EMBEDDING_MODEL)
+            remaining_chunks[article['public_url']] = len(chunks)
+            articles_by_url[article['public_url']] = article
+            yield from chunks
+
+    def mark_embedded_articles(batch):
+        finished = []
+        for chunk in batch:
+            url = chunk['metadata']['url']
+            remaining_chunks[url] -= 1
+            if remaining_chunks[url] == 0:
+                finished.append(articles_by_url[url])
+        if finished:
+            # An article marked embedded is never re-chunked, so its postings, signatures and summary must be on
+            # disk first
+            save_keyword_and_duplicate_indexes()
+            embed_article_summaries(finished)
+        for article in finished:
+            manifest.record_embedded(article['public_url'], article['title'], EMBEDDING_MODEL)
+
+    # Fetching and chunking the next article overlaps with embedding the chunks of the previous ones
+    embed_chunks_in_batches(iter_new_article_chunks(), on_batch_saved=mark_embedded_articles)
+
+    # Keep RSS order in the JSON file rather than the order articles finished in
+    ingested_urls = {article['public_url'] for article in ingested_articles}
+    ingested_articles = [article for article in new_articles if article['public_url'] in ingested_urls]
+    if ingested_articles and merge_articles_into_json(json_file_name, ingested_articles):
+        print(f"Updated {json_file_name} with {len(ingested_articles)} article(s)")
+
+    return ingested_articles
 
 
 if __name__ == '__main__':
@@ -221,6 +395,12 @@ if __name__ == '__main__':
         embedding_function=embedding_functions.DefaultEmbeddingFunction(),
     )
 
+    if len(get_vector_index()) == 0:
+        export_chroma_to_vector_index()
+    if len(get_article_index()) == 0:
+        with open('data.json', 'r') as file:
+            embed_article_summaries(json.load(file))
+
     check_for_latest_articles(f'https://stratechery.passport.online/feed/rss/{STRATECHERY_RSS_ID}',
                               'data.json',
                               embed=True)
@@ -0,0 +1,223 @@
+import json
+import os
+import re
+import threading
+import zlib
+import numpy as np
+
+from vector_index import INDEX_DIR, get_vector_index
+
+SIGNATURES_FILE = 'minhash.npy'
+SIGNATURE_IDS_FILE = 'minhash.json'
+DEDUP_REPORT_FILE = './dedup_report.jsonl'
+# Estimated Jaccard similarity of word shingles above which a chunk is dropped. Set to 0 to keep every chunk
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.8'))
+SHINGLE_SIZE = 5  # words per shingle
+MIN_SHINGLES = 8  # chunks shorter than this, e.g. a lone heading, are too short to judge and always kept
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 32  # 4 rows per band: pairs at 0.8 similarity share a band with probability ~1, pairs at 0.3 rarely do
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+_permutation_rng = np.random.default_rng(1)  # fixed, so signatures stay comparable across runs
+PERMUTATION_A = _permutation_rng.integers(1, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+PERMUTATION_B = _permutation_rng.integers(0, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def shingle_hashes(text):
+    """Returns the stable 32-bit hashes of the text's overlapping word shingles"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 0))}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64,
+                       count=len(shingles))
+
+
+def minhash_signature(text):
+    """Returns the text's MinHash signature, or None if it has too few shingles to compare"""
+    hashes = shingle_hashes(text)
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    permuted = (hashes[:, None] * PERMUTATION_A + PERMUTATION_B) % MERSENNE_PRIME & MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def band_keys(signature):
+    """Returns one hashable key per LSH band of a signature"""
+    return [(band, rows.tobytes()) for band, rows in enumerate(signature.reshape(LSH_BANDS, -1))]
+
+
+class DuplicateIndex:
+    """MinHash signatures of every embedded chunk, bucketed by LSH band so a new chunk is only compared with the
+    few chunks it collides with. Signatures are saved next to the vector index, so later runs only hash new chunks"""
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        self.ids = []
+        self.urls = []  # the article each row came from
+        self.signatures = np.empty((0, NUM_PERMUTATIONS), dtype=np.uint32)
+        self.id_to_row = {}  # live rows only: deleted and replaced rows stay in the buckets until the next save
+        self.url_to_rows = {}
+        self.buckets = {}  # band key -> rows
+        self.pending = []  # signatures added since the last save
+        self.num_checked = 0
+        self.num_dropped = 0
+        self.lock = threading.Lock()
+        self._load()
+
+    @property
+    def signatures_path(self):
+        return os.path.join(self.index_dir, SIGNATURES_FILE)
+
+    @property
+    def ids_path(self):
+        return os.path.join(self.index_dir, SIGNATURE_IDS_FILE)
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    def _load(self):
+        if not os.path.exists(self.ids_path):
+            return
+        with open(self.ids_path, 'r') as file:
+            stored = json.load(file)
+        self.signatures = np.load(self.signatures_path)
+        for chunk_id, url, signature in zip(stored['ids'], stored['urls'], self.signatures):
+            self._index_row(chunk_id, url, signature)
+
+    def _index_row(self, chunk_id, url, signature):
+        row = len(self.ids)
+        self.ids.append(chunk_id)
+        self.urls.append(url)
+        self.id_to_row[chunk_id] = row
+        self.url_to_rows.setdefault(url, []).append(row)
+        for key in band_keys(signature):
+            self.buckets.setdefault(key, []).append(row)
+        return row
+
+    def is_live(self, row):
+        return self.id_to_row.get(self.ids[row]) == row
+
+    def signature(self, row):
+        stored = len(self.signatures)
+        return self.signatures[row] if row < stored else self.pending[row - stored]
+
+    def find_duplicate(self, signature):
+        """Returns (chunk id, estimated similarity) of the most similar stored chunk at or above the threshold"""
+        candidates = {row for key in band_keys(signature) for row in self.buckets.get(key, ())}
+        best = None
+        for row in candidates:
+            if not self.is_live(row):
+                continue
+            similarity = float(np.mean(self.signature(row) == signature))
+            if similarity >= NEAR_DUPLICATE_THRESHOLD and (best is None or similarity > best[1]):
+                best = (self.ids[row], similarity)
+        return best
+
+    def add(self, chunk_id, url, signature):
+        with self.lock:
+            self._index_row(chunk_id, url, signature)
+            self.pending.append(signature)
+
+    def add_existing(self, ids, texts, metadatas):
+        """Adds the signatures of chunks that are already stored, without checking them for duplicates"""
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            signature = minhash_signature(text)
+            if signature is not None:
+                self.add(chunk_id, metadata['url'], signature)
+
+    def delete(self, ids):
+        with self.lock:
+            for chunk_id in ids:
+                self.id_to_row.pop(chunk_id, None)
+
+    def delete_article(self, url):
+        """Forgets an article's chunks, e.g. before it is re-chunked, so its new version isn't matched against its old"""
+        with self.lock:
+            for row in self.url_to_rows.pop(url, ()):
+                if self.is_live(row):
+                    del self.id_to_row[self.ids[row]]
+
+    def save(self):
+        """Writes the live signatures to disk, dropping deleted ones"""
+        with self.lock:
+            live = sorted(self.id_to_row.values())
+            signatures = np.stack([self.signature(row) for row in live]) if live else \
+                np.empty((0, NUM_PERMUTATIONS), dtype=np.uint32)
+            ids, urls = [self.ids[row] for row in live], [self.urls[row] for row in live]
+
+            self.ids, self.urls, self.id_to_row, self.url_to_rows, self.buckets = [], [], {}, {}, {}
+            self.signatures, self.pending = signatures, []
+            for chunk_id, url, signature in zip(ids, urls, signatures):
+                self._index_row(chunk_id, url, signature)
+
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_signatures_path = self.signatures_path + '.tmp.npy'
+            np.save(tmp_signatures_path, signatures)
+            os.replace(tmp_signatures_path, self.signatures_path)
+            tmp_ids_path = self.ids_path + '.tmp'
+            with open(tmp_ids_path, 'w') as file:
+                json.dump({'ids': ids, 'urls': urls}, file)
+            os.replace(tmp_ids_path, self.ids_path)
+
+    def print_report(self):
+        """Prints how many chunks were dropped since the last report"""
+        if self.num_checked:
+            print(f"Dropped {self.num_dropped}/{self.num_checked} chunks as near-duplicates "
+                  f"({self.num_dropped / self.num_checked:.1%}), listed in {DEDUP_REPORT_FILE}")
+        self.num_checked = self.num_dropped = 0
+
+
+def drop_near_duplicates(chunks, index=None):
+    """Yields the chunks that aren't near-duplicates of an already stored chunk, adding their signatures to the
+    index. Chunks are expected one article at a time, as chunk_article yields them. Each dropped chunk is appended
+    to DEDUP_REPORT_FILE along with the chunk it duplicates"""
+    if not NEAR_DUPLICATE_THRESHOLD:
+        yield from chunks
+        return
+    if index is None:
+        index = get_duplicate_index()
+    seen_urls = set()
+    for chunk in chunks:
+        url = chunk['metadata']['url']
+        if url not in seen_urls:
+            index.delete_article(url)
+            seen_urls.add(url)
+        index.num_checked += 1
+        signature = minhash_signature(chunk['page_content'])
+        if signature is None:
+            yield chunk
+            continue
+        duplicate = index.find_duplicate(signature)
+        if duplicate is not None:
+            index.num_dropped += 1
+            with open(DEDUP_REPORT_FILE, 'a') as file:
+                file.write(json.dumps({'chunk_id': chunk['chunk_id'], 'url': url, 'duplicate_of': duplicate[0],
+                                       'similarity': round(duplicate[1], 3)}) + '\n')
+            continue
+        index.add(chunk['chunk_id'], url, signature)
+        yield chunk
+
+
+def get_duplicate_index(index_dir=INDEX_DIR):
+    """Returns the process-wide DuplicateIndex, loading it from disk on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                index = DuplicateIndex(index_dir)
+                if not os.path.exists(index.ids_path):
+                    backfill(index, get_vector_index(index_dir))
+                _index = index
+    return _index
+
+
+def backfill(index, vector_index):
+    """Signs every chunk already in the vector index, once, so new chunks are also checked against the chunks
+    stored before deduplication existed"""
+    if len(vector_index):
+        print(f"Computing near-duplicate signatures for {len(vector_index)} stored chunks...")
+        index.add_existing(vector_index.ids, vector_index.documents, vector_index.metadatas)
+    index.save()
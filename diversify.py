@@ -0,0 +1,111 @@
+import numpy as np
+
+from context_packer import count_tokens
+
+MMR_CANDIDATES = 20  # chunks over-fetched for maximal marginal relevance to choose from
+MMR_LAMBDA = 0.7  # 1.0 ranks by relevance alone, lower values favour chunks unlike those already picked
+NEIGHBOR_DISTANCE = 1  # chunks on either side of a picked chunk that may be merged into its passage
+EXPANSION_TOKEN_SHARE = 0.75  # of the context budget passages may grow into, leaving room for article summaries
+PASSAGE_SEPARATOR = "\n\n"
+
+
+def maximal_marginal_relevance(query_embedding, embeddings, n_results, lambda_mult=MMR_LAMBDA):
+    """Returns the indices of n_results normalized embeddings, each picked greedily for its similarity to the query
+    minus its highest similarity to the ones already picked"""
+    n_results = min(n_results, len(embeddings))
+    if n_results == 0:
+        return np.empty(0, dtype=np.int64)
+    relevance = embeddings @ query_embedding
+    similarities = embeddings @ embeddings.T
+    available = np.ones(len(embeddings), dtype=bool)
+    max_similarity = np.full(len(embeddings), -np.inf, dtype=np.float32)
+    selected = []
+    for _ in range(n_results):
+        scores = relevance if not selected else lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        best = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarities[best], out=max_similarity)
+    return np.asarray(selected, dtype=np.int64)
+
+
+def chunk_positions(vector_index, title):
+    """Maps chunk_index to row for an article's chunks. Chunks stored before chunk positions were recorded are
+    left out, so they are never expanded"""
+    metadatas = vector_index.metadatas
+    return {metadatas[row]['chunk_index']: int(row) for row in vector_index.title_rows.get(title, ())
+            if 'chunk_index' in metadatas[row]}
+
+
+def join_chunks(vector_index, rows):
+    """Joins consecutive chunks into one passage, dropping text a chunk repeats from the previous one's overlap"""
+    documents = vector_index.documents
+    metadatas = vector_index.metadatas
+    passage = documents[rows[0]]
+    for previous, row in zip(rows, rows[1:]):
+        previous_end, start = metadatas[previous].get('end'), metadatas[row].get('start')
+        if previous_end is not None and start is not None and start < previous_end:
+            overlap = previous_end - start
+            passage += documents[row][overlap:]
+        else:
+            passage += PASSAGE_SEPARATOR + documents[row]
+    return passage
+
+
+def add_passage(grouped_chunks, vector_index, run, distances):
+    """Adds a run of adjacent chunks as one passage, ranked by its most relevant picked chunk"""
+    metadata = vector_index.metadatas[run[0]]
+    article = grouped_chunks.setdefault(metadata['title'], {'url': metadata['url'], 'documents': [], 'distances': []})
+    article['documents'].append(join_chunks(vector_index, run))
+    article['distances'].append(min(distances[row] for row in run if row in distances))
+
+
+def expand_to_passages(vector_index, rows, distances, token_budget, model="gpt-3.5-turbo"):
+    """Grows the picked chunks, most relevant first, with their neighbouring chunks while the chunks fit the token
+    budget, then merges each run of adjacent chunks into one passage. Returns the passages grouped by article, in
+    the {title: {url, documents, distances}} shape the context packer takes"""
+    order = np.argsort(distances)
+    rows = [int(rows[i]) for i in order]
+    distances = {row: float(distances[i]) for row, i in zip(rows, order)}
+    included = set(rows)
+    tokens_used = sum(count_tokens(vector_index.documents[row], model) for row in rows)
+    positions = {}  # title -> {chunk_index: row}
+    for row in rows:
+        metadata = vector_index.metadatas[row]
+        if 'chunk_index' not in metadata:
+            continue
+        if metadata['title'] not in positions:
+            positions[metadata['title']] = chunk_positions(vector_index, metadata['title'])
+        for step in range(1, NEIGHBOR_DISTANCE + 1):
+            for neighbor_index in (metadata['chunk_index'] - step, metadata['chunk_index'] + step):
+                neighbor = positions[metadata['title']].get(neighbor_index)
+                if neighbor is None or neighbor in included:
+                    continue
+                cost = count_tokens(vector_index.documents[neighbor], model)
+                if tokens_used + cost <= token_budget:
+                    included.add(neighbor)
+                    tokens_used += cost
+
+    grouped_chunks = {}
+    for title, title_positions in positions.items():
+        run = []
+        for chunk_index in sorted(title_positions):
+            row = title_positions[chunk_index]
+            if row not in included:
+                continue
+            if run and vector_index.metadatas[run[-1]]['chunk_index'] != chunk_index - 1:
+                add_passage(grouped_chunks, vector_index, run, distances)
+                run = []
+            run.append(row)
+        if run:
+            add_passage(grouped_chunks, vector_index, run, distances)
+    for row in rows:
+        if 'chunk_index' not in vector_index.metadatas[row]:
+            add_passage(grouped_chunks, vector_index, [row], distances)
+
+    for article in grouped_chunks.values():
+        passages = sorted(zip(article['distances'], article['documents']), key=lambda passage: passage[0])
+        article['distances'] = [distance for distance, _ in passages]
+        article['documents'] = [document for _, document in passages]
+    return dict(sorted(grouped_chunks.items(), key=lambda item: item[1]['distances'][0]))
+
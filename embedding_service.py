@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import instrumentation
+from vector_index import embed_texts
+
+QUERY_CACHE_SIZE = 4096
+MICRO_BATCH_WAIT = 0.005  # seconds the worker waits for more queries before embedding a batch
+MICRO_BATCH_MAX_SIZE = 64
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def normalize_query(text):
+    """Collapses whitespace and case. all-MiniLM-L6-v2 is uncased, so this doesn't change the embedding"""
+    return ' '.join(text.lower().split())
+
+
+class EmbeddingService:
+    """Embeds query texts for every session in the process. Repeated queries are served from an LRU cache, and
+    concurrent queries are collected for a few milliseconds and embedded in one batch on a worker thread"""
+
+    def __init__(self, embed_function=embed_texts, cache_size=QUERY_CACHE_SIZE, batch_wait=MICRO_BATCH_WAIT,
+                 max_batch_size=MICRO_BATCH_MAX_SIZE):
+        self.embed_function = embed_function
+        self.cache_size = cache_size
+        self.batch_wait = batch_wait
+        self.max_batch_size = max_batch_size
+        self.cache = OrderedDict()
+        self.in_flight = {}  # normalized query -> Future, so identical concurrent queries are embedded once
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+        self._worker.start()
+
+    def submit(self, text):
+        """Returns a Future that resolves to the query's normalized embedding"""
+        key = normalize_query(text)
+        with self._lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                instrumentation.count('query_embedding_cache_hits')
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            if key in self.in_flight:
+                self.hits += 1
+                return self.in_flight[key]
+            self.misses += 1
+            future = self.in_flight[key] = Future()
+        self._queue.put((key, future))
+        return future
+
+    def embed(self, text):
+        return self.submit(text).result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            keys = [key for key, _ in batch]
+            try:
+                embeddings = self.embed_function(keys)
+            except Exception as error:
+                with self._lock:
+                    for key, future in batch:
+                        self.in_flight.pop(key, None)
+                        future.set_exception(error)
+                continue
+
+            with self._lock:
+                self.batches += 1
+                for (key, future), embedding in zip(batch, embeddings):
+                    self.cache[key] = embedding
+                    self.in_flight.pop(key, None)
+                    future.set_result(embedding)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+
+def get_embedding_service():
+    """Returns the process-wide EmbeddingService, starting its worker on first use"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService()
+    return _service
+
+
+def embed_query(text):
+    """Returns the normalized embedding of a single query"""
+    return get_embedding_service().embed(text)
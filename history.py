@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_client import BACKGROUND, chat_completion
+
+HISTORY_TURNS_KEPT = 4  # most recent user/assistant turns sent verbatim
+HISTORY_SUMMARY_MODEL = "gpt-3.5-turbo"
+
+# Folds older turns into summaries off the request path, for every conversation in the process
+SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="history-summary")
+
+SUMMARY_PROMPT_TEMPLATE = (
+    "You maintain a running summary of a conversation between a user and a bot that answers questions about "
+    "Ben Thompson's Stratechery articles. Update the summary with the new messages below. Keep the questions asked, "
+    "the articles cited with their URLs, and any facts or preferences the user stated. Be concise: no more than "
+    "150 words of plain text.\n\nCurrent summary: {summary}\n\nNew messages:\n{messages}"
+)
+
+
+def is_conversation_message(message):
+    """Returns True for user messages and assistant answers, False for system prompts and tool payloads"""
+    return message["role"] in ("user", "assistant") and bool(message.get("content"))
+
+
+class ConversationHistory:
+    """Keeps the last few turns of a conversation verbatim and folds older turns into a rolling summary. The summary
+    is updated in the background: until an update lands, the turns it folds are still sent verbatim"""
+
+    def __init__(self, turns_kept=HISTORY_TURNS_KEPT, model=HISTORY_SUMMARY_MODEL):
+        self.turns_kept = turns_kept
+        self.model = model
+        self.summary = ""
+        self.num_summarized = 0  # conversation messages already folded into the summary
+        self.pending = None  # Future of the (summary, num_summarized) being computed
+        self.lock = threading.Lock()
+
+    def _summarize(self, summary, messages, num_summarized):
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        completion = chat_completion(
+            self.model,
+            [{"role": "system", "content": SUMMARY_PROMPT_TEMPLATE.format(summary=summary or "(none)",
+                                                                          messages=transcript)}],
+            priority=BACKGROUND
+        )
+        return completion.choices[0].message.content, num_summarized
+
+    def _apply_pending_summary(self):
+        if self.pending is None or not self.pending.done():
+            return
+        try:
+            self.summary, self.num_summarized = self.pending.result()
+        except Exception as error:
+            print(f"Conversation summary failed ({error!r}), retrying on the next turn")
+        self.pending = None
+
+    def build_messages(self, system_message, messages):
+        """Returns the system message, a summary of older turns, and the turns since that summary verbatim.
+        Never waits on the summary: turns that have aged out are folded in for a later call"""
+        conversation = [{"role": message["role"], "content": message["content"]}
+                        for message in messages if is_conversation_message(message)]
+
+        user_indexes = [i for i, message in enumerate(conversation) if message["role"] == "user"]
+        recent_start = user_indexes[-self.turns_kept] if len(user_indexes) > self.turns_kept else 0
+
+        with self.lock:
+            self._apply_pending_summary()
+            if recent_start > self.num_summarized and self.pending is None:
+                self.pending = SUMMARY_EXECUTOR.submit(self._summarize, self.summary,
+                                                       conversation[self.num_summarized:recent_start], recent_start)
+            summary, num_summarized = self.summary, self.num_summarized
+
+        message_chain = [{"role": "system", "content": system_message}]
+        if summary:
+            message_chain.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        return message_chain + conversation[num_summarized:]
@@ -0,0 +1,179 @@
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+import numpy as np
+
+# Every finished turn is appended here as one JSON line. Set METRICS_FILE to an empty string to turn this off
+METRICS_FILE = os.getenv('METRICS_FILE', './metrics.jsonl')
+METRICS_WINDOW = 2048  # most recent samples per stage used for the percentile rollups
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current_turn = contextvars.ContextVar('current_turn', default=None)
+
+
+class Turn:
+    """The spans and counts recorded while answering one query"""
+
+    def __init__(self, model, **attributes):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = {}  # stage -> seconds, summed if a stage runs more than once
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add_span(self, stage, seconds):
+        with self.lock:
+            self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def add_count(self, name, amount):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def to_dict(self):
+        return {'turn_id': self.id, 'model': self.model, 'started_at': self.started_at, **self.attributes,
+                'spans': self.spans, 'counts': self.counts}
+
+
+class Metrics:
+    """Process-wide rollups: a sliding window of latencies per stage and running totals per counter"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.samples = {}
+        self.sample_counts = {}
+        self.sample_sums = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            self.sample_counts[stage] = self.sample_counts.get(stage, 0) + 1
+            self.sample_sums[stage] = self.sample_sums.get(stage, 0.0) + seconds
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + amount
+
+    def rollups(self):
+        """Returns {stage: {count, p50, p95, p99}} in seconds over the recent window"""
+        with self.lock:
+            samples = {stage: np.asarray(values) for stage, values in self.samples.items()}
+            counts = dict(self.sample_counts)
+        return {stage: {'count': counts[stage],
+                        **{f"p{int(q * 100)}": float(np.quantile(values, q)) for q in QUANTILES}}
+                for stage, values in samples.items()}
+
+    def prometheus_text(self):
+        """Renders the rollups and totals in the Prometheus text exposition format"""
+        rollups = self.rollups()
+        with self.lock:
+            sums = dict(self.sample_sums)
+            totals = dict(self.totals)
+        lines = ["# TYPE rag_stage_seconds summary"]
+        for stage, rollup in sorted(rollups.items()):
+            for q in QUANTILES:
+                lines.append(f'rag_stage_seconds{{stage="{stage}",quantile="{q}"}} {rollup[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {rollup["count"]}')
+        lines.append("# TYPE rag_events_total counter")
+        for name, total in sorted(totals.items()):
+            lines.append(f'rag_events_total{{name="{name}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+_file_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def turn(model, **attributes):
+    """Records a turn: spans and counts recorded inside it, including on threads started with copy_context, are
+    attached to it, and it is written to METRICS_FILE when it ends"""
+    current = Turn(model, **attributes)
+    token = _current_turn.set(current)
+    try:
+        yield current
+    finally:
+        try:
+            _current_turn.reset(token)
+        except ValueError:
+            pass  # a generator closed from another context, e.g. during garbage collection
+        record_span('turn', current.elapsed(), current)
+        if METRICS_FILE:
+            line = json.dumps(current.to_dict())
+            with _file_lock, open(METRICS_FILE, 'a') as file:
+                file.write(line + '\n')
+
+
+def record_span(stage, seconds, current=None):
+    current = current or _current_turn.get()
+    if current is not None:
+        current.add_span(stage, seconds)
+    METRICS.observe(stage, seconds)
+
+
+def count(name, amount=1):
+    """Adds to a counter of the current turn and the process-wide totals"""
+    current = _current_turn.get()
+    if current is not None:
+        current.add_count(name, amount)
+    METRICS.increment(name, amount)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Times the enclosed block as a stage of the current turn"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+def mark_first_token():
+    """Records time-to-first-token the first time it is called in a turn"""
+    current = _current_turn.get()
+    if current is not None and 'time_to_first_token' not in current.spans:
+        record_span('time_to_first_token', current.elapsed(), current)
+
+
+def record_usage(usage):
+    """Counts the prompt and completion tokens reported by an OpenAI response"""
+    if usage is not None:
+        count('prompt_tokens', usage.prompt_tokens)
+        count('completion_tokens', usage.completion_tokens)
+
+
+def rollups_from_file(path=METRICS_FILE):
+    """Computes p50/p95/p99 per stage from a METRICS_FILE"""
+    metrics = Metrics(window=sys.maxsize)
+    with open(path, 'r') as file:
+        for line in file:
+            recorded = json.loads(line)
+            for stage, seconds in recorded['spans'].items():
+                metrics.observe(stage, seconds)
+            for name, amount in recorded['counts'].items():
+                metrics.increment(name, amount)
+    return metrics
+
+
+if __name__ == '__main__':
+    file_metrics = rollups_from_file(sys.argv[1] if len(sys.argv) > 1 else METRICS_FILE)
+    for stage_name, stage_rollup in sorted(file_metrics.rollups().items()):
+        print(f"{stage_name:>22}: n={stage_rollup['count']:<6} " +
+              "  ".join(f"{key}={1000 * value:8.1f}ms" for key, value in stage_rollup.items() if key != 'count'))
+    for counter_name, counter_total in sorted(file_metrics.totals.items()):
+        print(f"{counter_name:>22}: {counter_total}")
@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import threading
+from collections import Counter
+import numpy as np
+
+from vector_index import INDEX_DIR
+
+POSTINGS_FILE = 'bm25.npz'
+TERMS_FILE = 'bm25.json'
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOPWORDS = frozenset("""a an and are as at be but by for from has have he his i in is it its of on or that the their
+there they this to was were what when which who will with you your""".split())
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Lowercases text and splits it into word tokens, dropping stopwords"""
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+class LexicalIndex:
+    """A BM25 inverted index over article chunks. Postings are stored as compact CSR arrays (term offsets into
+    parallel doc/term-frequency arrays); chunks added since the last save live in a small in-memory delta"""
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        self.ids = []
+        self.id_to_doc = {}
+        self.doc_lengths = np.empty(0, dtype=np.int32)
+        self.deleted = np.empty(0, dtype=bool)
+        self.terms = {}  # term -> term id in the CSR arrays
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.empty(0, dtype=np.int32)
+        self.tfs = np.empty(0, dtype=np.uint16)
+        self.delta = {}  # term -> ([doc], [tf]) for chunks added since the last save
+        self.lock = threading.RLock()  # serializes writes; add re-enters it through delete
+        self._load()
+
+    @property
+    def postings_path(self):
+        return os.path.join(self.index_dir, POSTINGS_FILE)
+
+    @property
+    def terms_path(self):
+        return os.path.join(self.index_dir, TERMS_FILE)
+
+    def __len__(self):
+        return len(self.ids) - int(self.deleted.sum())
+
+    def _load(self):
+        if not os.path.exists(self.terms_path):
+            return
+        with open(self.terms_path, 'r') as file:
+            stored = json.load(file)
+        self.ids = stored['ids']
+        self.id_to_doc = {chunk_id: doc for doc, chunk_id in enumerate(self.ids)}
+        self.terms = {term: term_id for term_id, term in enumerate(stored['terms'])}
+        with np.load(self.postings_path) as postings:
+            self.offsets = postings['offsets']
+            self.docs = postings['docs']
+            self.tfs = postings['tfs']
+            self.doc_lengths = postings['doc_lengths']
+            self.deleted = postings['deleted']
+
+    def add(self, ids, texts):
+        """Indexes chunks. Re-added ids replace their previous version"""
+        with self.lock:
+            self.delete(ids)
+            doc_lengths = []
+            for chunk_id, text in zip(ids, texts):
+                doc = len(self.ids)
+                self.ids.append(chunk_id)
+                self.id_to_doc[chunk_id] = doc
+                counts = Counter(tokenize(text))
+                doc_lengths.append(sum(counts.values()))
+                for term, tf in counts.items():
+                    docs, tfs = self.delta.setdefault(term, ([], []))
+                    docs.append(doc)
+                    tfs.append(min(tf, np.iinfo(np.uint16).max))
+            self.doc_lengths = np.concatenate([self.doc_lengths, np.asarray(doc_lengths, dtype=np.int32)])
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(doc_lengths), dtype=bool)])
+
+    def delete(self, ids):
+        with self.lock:
+            for chunk_id in ids:
+                doc = self.id_to_doc.pop(chunk_id, None)
+                if doc is not None:
+                    self.deleted[doc] = True
+
+    def postings(self, term):
+        """Returns the (docs, tfs) arrays for a term, including unsaved additions"""
+        docs, tfs = [], []
+        term_id = self.terms.get(term)
+        if term_id is not None:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs.append(self.docs[start:end])
+            tfs.append(self.tfs[start:end])
+        if term in self.delta:
+            docs.append(np.asarray(self.delta[term][0], dtype=np.int32))
+            tfs.append(np.asarray(self.delta[term][1], dtype=np.uint16))
+        if not docs:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.uint16)
+        return np.concatenate(docs), np.concatenate(tfs)
+
+    def save(self):
+        """Merges unsaved additions into the CSR arrays and writes them to disk, dropping deleted chunks' postings"""
+        with self.lock:
+            terms = sorted(set(self.terms) | set(self.delta))
+            docs, tfs, offsets = [], [], [0]
+            for term in terms:
+                term_docs, term_tfs = self.postings(term)
+                live = ~self.deleted[term_docs]
+                docs.append(term_docs[live])
+                tfs.append(term_tfs[live])
+                offsets.append(offsets[-1] + int(live.sum()))
+
+            self.terms = {term: term_id for term_id, term in enumerate(terms)}
+            self.offsets = np.asarray(offsets, dtype=np.int64)
+            self.docs = np.concatenate(docs) if docs else np.empty(0, dtype=np.int32)
+            self.tfs = np.concatenate(tfs) if tfs else np.empty(0, dtype=np.uint16)
+            self.delta = {}
+
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_postings_path = self.postings_path + '.tmp.npz'
+            np.savez(tmp_postings_path, offsets=self.offsets, docs=self.docs, tfs=self.tfs,
+                     doc_lengths=self.doc_lengths, deleted=self.deleted)
+            os.replace(tmp_postings_path, self.postings_path)
+            tmp_terms_path = self.terms_path + '.tmp'
+            with open(tmp_terms_path, 'w') as file:
+                json.dump({'ids': self.ids, 'terms': terms}, file)
+            os.replace(tmp_terms_path, self.terms_path)
+
+    def search(self, query_text, n_results=20):
+        """Returns the (chunk ids, BM25 scores) of the best-matching chunks, best first"""
+        num_docs = len(self)
+        if num_docs == 0:
+            return [], np.empty(0, dtype=np.float32)
+        live_lengths = self.doc_lengths[~self.deleted]
+        average_length = max(float(live_lengths.mean()), 1.0)
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize(query_text)):
+            docs, tfs = self.postings(term)
+            if len(docs) == 0:
+                continue
+            document_frequency = int((~self.deleted[docs]).sum())
+            idf = np.log(1.0 + (num_docs - document_frequency + 0.5) / (document_frequency + 0.5))
+            tfs = tfs.astype(np.float32)
+            norms = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_lengths[docs] / average_length)
+            np.add.at(scores, docs, idf * tfs * (BM25_K1 + 1.0) / (tfs + norms))
+        scores[self.deleted] = 0.0
+
+        n_results = min(n_results, int(np.count_nonzero(scores)))
+        if n_results == 0:
+            return [], np.empty(0, dtype=np.float32)
+        docs = np.argpartition(-scores, n_results - 1)[:n_results]
+        docs = docs[np.argsort(-scores[docs])]
+        return [self.ids[doc] for doc in docs], scores[docs]
+
+
+def get_lexical_index(index_dir=INDEX_DIR):
+    """Returns the process-wide LexicalIndex, loading it from disk on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LexicalIndex(index_dir)
+    return _index
@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+import instrumentation
+from rate_limit import backoff_delays
+
+# Connection pool shared by every request in the process, kept warm so requests skip the TCP/TLS handshake
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 60.0  # seconds an idle connection is kept open
+REQUEST_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Requests in flight per model across all sessions and background jobs
+MODEL_CONCURRENCY = {
+    'gpt-3.5-turbo': 32,
+    'gpt-4-turbo-preview': 8,
+}
+DEFAULT_MODEL_CONCURRENCY = 8
+BACKGROUND_SHARE = 0.5  # background work never holds more than this share of a model's slots
+MAX_QUEUE_DEPTH = 64  # requests waiting per model before new ones are rejected
+MAX_RETRIES = 4
+
+INTERACTIVE = 0  # chat answers a user is waiting on
+BACKGROUND = 1  # article summarization, conversation summaries, semantic cache warm-up, and other batch work
+
+_clients = {}
+_clients_lock = threading.Lock()
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class SchedulerBusy(Exception):
+    """Raised instead of queueing a request when too many requests for its model are already waiting"""
+
+
+def get_openai_client():
+    """Returns the process-wide OpenAI client. Retries are left to the scheduler"""
+    with _clients_lock:
+        if 'sync' not in _clients:
+            limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                  keepalive_expiry=KEEPALIVE_EXPIRY)
+            _clients['sync'] = OpenAI(max_retries=0, timeout=REQUEST_TIMEOUT,
+                                      http_client=httpx.Client(limits=limits, timeout=REQUEST_TIMEOUT))
+        return _clients['sync']
+
+
+def get_async_openai_client():
+    """Returns the process-wide AsyncOpenAI client, for the headless API"""
+    with _clients_lock:
+        if 'async' not in _clients:
+            limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                  keepalive_expiry=KEEPALIVE_EXPIRY)
+            _clients['async'] = AsyncOpenAI(max_retries=0, timeout=REQUEST_TIMEOUT,
+                                            http_client=httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT))
+        return _clients['async']
+
+
+class LLMScheduler:
+    """Hands out per-model request slots. Waiting requests are served interactive-first, background work is capped
+    at a share of the slots so a summarization run can't starve chat, and queues are bounded"""
+
+    def __init__(self, model_concurrency=None, background_share=BACKGROUND_SHARE, max_queue_depth=MAX_QUEUE_DEPTH):
+        self.model_concurrency = dict(MODEL_CONCURRENCY if model_concurrency is None else model_concurrency)
+        self.background_share = background_share
+        self.max_queue_depth = max_queue_depth
+        self.running = {}  # model -> [interactive, background] requests holding a slot
+        self.waiting = {}  # model -> heap of (priority, sequence, Future)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _limits(self, model):
+        total = self.model_concurrency.get(model, DEFAULT_MODEL_CONCURRENCY)
+        return total, max(1, int(total * self.background_share))
+
+    def _can_run(self, model, priority):
+        total, background_limit = self._limits(model)
+        running = self.running.setdefault(model, [0, 0])
+        if sum(running) >= total:
+            return False
+        return priority == INTERACTIVE or running[BACKGROUND] < background_limit
+
+    def queue_depth(self, model, priority=INTERACTIVE):
+        with self._lock:
+            return sum(1 for entry in self.waiting.get(model, ()) if entry[0] == priority)
+
+    def is_saturated(self, model):
+        """Returns True if a new interactive request for the model would be rejected"""
+        return self.queue_depth(model) >= self.max_queue_depth
+
+    def request_slot(self, model, priority=INTERACTIVE):
+        """Returns a Future that resolves once the request may run. Interactive requests raise SchedulerBusy rather
+        than join a full queue; background requests always wait, since their own worker pools bound them"""
+        future = Future()
+        with self._lock:
+            waiting = self.waiting.setdefault(model, [])
+            if not any(entry[0] <= priority for entry in waiting) and self._can_run(model, priority):
+                self.running[model][priority] += 1
+                future.set_running_or_notify_cancel()
+                future.set_result((model, priority))
+                return future
+            if priority == INTERACTIVE:
+                queue_depth = sum(1 for entry in waiting if entry[0] == INTERACTIVE)
+                if queue_depth >= self.max_queue_depth:
+                    raise SchedulerBusy(f"{queue_depth} requests for {model} are already waiting")
+            heapq.heappush(waiting, (priority, next(self._sequence), future))
+        return future
+
+    def release(self, slot):
+        model, priority = slot
+        with self._lock:
+            self.running[model][priority] -= 1
+            self._grant(model)
+
+    def _grant(self, model):
+        # Interactive requests sort first, so once the head can't run nothing behind it can either
+        waiting = self.waiting.get(model, [])
+        while waiting and self._can_run(model, waiting[0][0]):
+            priority, _, future = heapq.heappop(waiting)
+            if not future.set_running_or_notify_cancel():
+                continue  # the caller gave up waiting
+            self.running[model][priority] += 1
+            future.set_result((model, priority))
+
+    def cancel(self, future):
+        """Gives up a slot request, releasing the slot if it was granted in the meantime"""
+        if not future.cancel():
+            self.release(future.result())
+
+
+def get_scheduler():
+    """Returns the process-wide LLMScheduler"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler()
+    return _scheduler
+
+
+def is_retryable_error(error):
+    """Returns True for rate limits, server errors, timeouts, and dropped connections"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, httpx.TransportError))
+
+
+def _release_after_stream(scheduler, slot, stream):
+    try:
+        for chunk in stream:
+            instrumentation.record_usage(getattr(chunk, 'usage', None))
+            yield chunk
+    finally:
+        scheduler.release(slot)
+
+
+async def _arelease_after_stream(scheduler, slot, stream):
+    try:
+        async for chunk in stream:
+            instrumentation.record_usage(getattr(chunk, 'usage', None))
+            yield chunk
+    finally:
+        scheduler.release(slot)
+
+
+def chat_completion(model, messages, priority=INTERACTIVE, stream=False, **kwargs):
+    """Creates a chat completion through the shared client once the scheduler grants a slot, retrying 429s and 5xxs
+    with jittered backoff. Streams hold their slot until they are fully read or closed"""
+    scheduler = get_scheduler()
+    if stream:
+        kwargs.setdefault('stream_options', {"include_usage": True})  # token counts arrive in a final chunk
+    with instrumentation.span('llm_queue_wait'):
+        slot = scheduler.request_slot(model, priority).result()
+    try:
+        delays = backoff_delays(MAX_RETRIES)
+        while True:
+            try:
+                response = get_openai_client().chat.completions.create(model=model, messages=messages, stream=stream,
+                                                                       **kwargs)
+                break
+            except Exception as error:
+                delay = next(delays, None)
+                if delay is None or not is_retryable_error(error):
+                    raise
+                print(f"OpenAI request failed ({error}), retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+    except BaseException:
+        scheduler.release(slot)
+        raise
+
+    if stream:
+        return _release_after_stream(scheduler, slot, response)
+    scheduler.release(slot)
+    instrumentation.record_usage(response.usage)
+    return response
+
+
+async def achat_completion(model, messages, priority=INTERACTIVE, stream=False, **kwargs):
+    """The asyncio version of chat_completion"""
+    scheduler = get_scheduler()
+    if stream:
+        kwargs.setdefault('stream_options', {"include_usage": True})
+    future = scheduler.request_slot(model, priority)
+    try:
+        with instrumentation.span('llm_queue_wait'):
+            slot = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        scheduler.cancel(future)
+        raise
+    try:
+        delays = backoff_delays(MAX_RETRIES)
+        while True:
+            try:
+                response = await get_async_openai_client().chat.completions.create(model=model, messages=messages,
+                                                                                   stream=stream, **kwargs)
+                break
+            except Exception as error:
+                delay = next(delays, None)
+                if delay is None or not is_retryable_error(error):
+                    raise
+                print(f"OpenAI request failed ({error}), retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+    except BaseException:
+        scheduler.release(slot)
+        raise
+
+    if stream:
+        return _arelease_after_stream(scheduler, slot, response)
+    scheduler.release(slot)
+    instrumentation.record_usage(response.usage)
+    return response
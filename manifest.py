@@ -0,0 +1,89 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+MANIFEST_FILE = './manifest.db'
+PENDING = 'pending'
+DONE = 'done'
+
+
+def content_hash(markdown_content):
+    return hashlib.sha256(markdown_content.encode('utf-8')).hexdigest()
+
+
+class IngestionManifest:
+    """A SQLite record of every ingested article: its content hash, summary, chunk ids, and embedding model.
+    Lets an ingestion run look up what is new or changed per article and resume where a crashed run stopped"""
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS articles (
+                    url TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    content_hash TEXT,
+                    summary TEXT,
+                    summary_status TEXT NOT NULL DEFAULT 'pending',
+                    chunk_ids TEXT,
+                    embedding_model TEXT,
+                    embed_status TEXT NOT NULL DEFAULT 'pending',
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS articles_title ON articles (title)")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM articles").fetchone()[0]
+
+    def get(self, url):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM articles WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        row['chunk_ids'] = json.loads(row['chunk_ids']) if row['chunk_ids'] else []
+        return row
+
+    def is_complete(self, url, embedding_model, embed=True):
+        row = self.get(url)
+        if row is None or row['summary_status'] != DONE:
+            return False
+        return not embed or (row['embed_status'] == DONE and row['embedding_model'] == embedding_model)
+
+    def pending(self, articles, embedding_model, embed=True):
+        """Returns the articles that are new, were interrupted mid-ingestion, or were embedded with another model"""
+        return [article for article in articles if not self.is_complete(article['public_url'], embedding_model, embed)]
+
+    def _upsert(self, url, title, **columns):
+        columns['updated_at'] = time.time()
+        names = ', '.join(columns)
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f"{name} = excluded.{name}" for name in columns)
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT INTO articles (url, title, {names}) VALUES (?, ?, {placeholders}) "
+                f"ON CONFLICT(url) DO UPDATE SET title = excluded.title, {updates}",
+                (url, title, *columns.values()))
+
+    def record_summary(self, article, markdown_hash, summary):
+        self._upsert(article['public_url'], article['title'], content_hash=markdown_hash, summary=summary,
+                     summary_status=DONE)
+
+    def record_chunks(self, article, chunk_ids):
+        self._upsert(article['public_url'], article['title'], chunk_ids=json.dumps(chunk_ids), embed_status=PENDING)
+
+    def record_embedded(self, url, title, embedding_model):
+        self._upsert(url, title, embedding_model=embedding_model, embed_status=DONE)
+
+    def import_articles(self, articles, embedding_model):
+        """Records already-ingested articles (e.g. from data.json) as summarized and embedded"""
+        for article in articles:
+            self._upsert(article['public_url'], article['title'], summary=article.get('summary'),
+                         summary_status=DONE if article.get('summary') else PENDING,
+                         embedding_model=embedding_model, embed_status=DONE)
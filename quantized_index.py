@@ -0,0 +1,156 @@
+import hashlib
+import os
+import time
+import numpy as np
+
+from vector_index import normalize
+
+INT8 = 'int8'
+BINARY = 'binary'
+INT8_FILE = 'embeddings.i8'
+INT8_SCALES_FILE = 'int8_scales.npy'
+BINARY_FILE = 'embeddings.b1'
+ROW_IDS_SUFFIX = '.rows'  # next to the codes: a hash of the row ids they were built from
+RERANK_FACTORS = {INT8: 4, BINARY: 40}  # first-pass candidates per requested result
+BLOCK_ROWS = 65536  # rows scored at a time, so the first pass never materializes a full float matrix
+
+# Number of set bits in every possible byte, for Hamming distances over packed bit vectors
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def row_ids_hash(vector_index):
+    """Fingerprints the index's rows, so codes built before rows were deleted and appended aren't used"""
+    return hashlib.sha256('\n'.join(vector_index.ids).encode('utf-8')).hexdigest()
+
+
+def codes_path(vector_index, mode):
+    return os.path.join(vector_index.index_dir, INT8_FILE if mode == INT8 else BINARY_FILE)
+
+
+def build_quantized_index(vector_index, mode=INT8):
+    """Writes int8 scalar-quantized or 1-bit sign-quantized copies of the index's embeddings next to it"""
+    embeddings = vector_index.embeddings
+    rows_path = codes_path(vector_index, mode) + ROW_IDS_SUFFIX
+    if os.path.exists(rows_path):
+        os.remove(rows_path)  # the codes are stale until the new ones are written
+    if mode == INT8:
+        scales = np.maximum(np.abs(embeddings).max(axis=0), 1e-6).astype(np.float32) / 127.0
+        path = os.path.join(vector_index.index_dir, INT8_FILE)
+        with open(path + '.tmp', 'wb') as file:
+            for start in range(0, len(embeddings), BLOCK_ROWS):
+                block = np.asarray(embeddings[start:start + BLOCK_ROWS]) / scales
+                file.write(np.clip(np.rint(block), -127, 127).astype(np.int8).tobytes())
+        os.replace(path + '.tmp', path)
+        np.save(os.path.join(vector_index.index_dir, INT8_SCALES_FILE), scales)
+    elif mode == BINARY:
+        path = os.path.join(vector_index.index_dir, BINARY_FILE)
+        with open(path + '.tmp', 'wb') as file:
+            for start in range(0, len(embeddings), BLOCK_ROWS):
+                file.write(np.packbits(np.asarray(embeddings[start:start + BLOCK_ROWS]) > 0, axis=1).tobytes())
+        os.replace(path + '.tmp', path)
+    else:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    with open(rows_path + '.tmp', 'w') as file:
+        file.write(row_ids_hash(vector_index))
+    os.replace(rows_path + '.tmp', rows_path)
+    return QuantizedIndex(vector_index, mode)
+
+
+class QuantizedIndex:
+    """A memory-mapped int8 or binary copy of a VectorIndex. Searches score every row cheaply on the quantized
+    codes, then re-rank the best candidates exactly against the float embeddings"""
+
+    def __init__(self, vector_index, mode=INT8):
+        self.vector_index = vector_index
+        self.mode = mode
+        num_rows, dim = len(vector_index), vector_index.dim
+        if mode == INT8:
+            self.codes = np.memmap(os.path.join(vector_index.index_dir, INT8_FILE), dtype=np.int8, mode='r',
+                                   shape=(num_rows, dim))
+            self.scales = np.load(os.path.join(vector_index.index_dir, INT8_SCALES_FILE))
+        elif mode == BINARY:
+            self.codes = np.memmap(os.path.join(vector_index.index_dir, BINARY_FILE), dtype=np.uint8, mode='r',
+                                   shape=(num_rows, (dim + 7) // 8))
+        else:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+
+    @staticmethod
+    def exists(vector_index, mode):
+        """Whether codes were built for the index's current rows"""
+        path = codes_path(vector_index, mode)
+        itemsize = vector_index.dim if mode == INT8 else (vector_index.dim + 7) // 8
+        if not (os.path.exists(path) and os.path.exists(path + ROW_IDS_SUFFIX)) or \
+                os.path.getsize(path) != len(vector_index) * itemsize:
+            return False
+        with open(path + ROW_IDS_SUFFIX, 'r') as file:
+            return file.read() == row_ids_hash(vector_index)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def _first_pass_scores(self, query_embedding, rows):
+        """Returns a higher-is-better approximate score for each row"""
+        if self.mode == INT8:
+            query = (query_embedding * self.scales).astype(np.float32)
+        else:
+            query = np.packbits(query_embedding > 0)
+        scores = np.empty(len(rows) if rows is not None else len(self.codes), dtype=np.float32)
+        for start in range(0, len(scores), BLOCK_ROWS):
+            block_rows = slice(start, start + BLOCK_ROWS) if rows is None else rows[start:start + BLOCK_ROWS]
+            codes = np.asarray(self.codes[block_rows])
+            if self.mode == INT8:
+                scores[start:start + len(codes)] = codes.astype(np.float32) @ query
+            else:
+                scores[start:start + len(codes)] = -POPCOUNT[np.bitwise_xor(codes, query)].sum(axis=1, dtype=np.float32)
+        return scores
+
+    def search(self, query_embedding, n_results=7, rows=None, rerank_factor=None):
+        """Returns the (rows, distances) of the n_results nearest chunks, nearest first, with exact distances"""
+        rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        query_embedding = normalize(query_embedding)[0]
+        scores = self._first_pass_scores(query_embedding, rows)
+        if len(scores) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        num_candidates = min(n_results * (rerank_factor or RERANK_FACTORS[self.mode]), len(scores))
+        candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        if rows is not None:
+            candidates = rows[candidates]
+        candidates = np.sort(candidates)  # sequential reads from the float memmap
+
+        similarities = np.asarray(self.vector_index.embeddings[candidates]) @ query_embedding
+        top = np.argsort(-similarities)[:n_results]
+        return candidates[top], 1.0 - similarities[top]
+
+
+def measure_recall(vector_index, quantized_index, num_queries=200, n_results=7, seed=0):
+    """Compares quantized search with exact search, using stored chunk embeddings as queries.
+    Returns recall@n_results and the mean latency of each search"""
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(vector_index), size=min(num_queries, len(vector_index)), replace=False)
+    recalls, exact_seconds, quantized_seconds = [], 0.0, 0.0
+    for row in query_rows:
+        query_embedding = np.asarray(vector_index.embeddings[row])
+        start = time.perf_counter()
+        exact_rows, _ = vector_index.search(query_embedding, n_results, exact=True)
+        exact_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        approximate_rows, _ = quantized_index.search(query_embedding, n_results)
+        quantized_seconds += time.perf_counter() - start
+        recalls.append(len(set(exact_rows.tolist()) & set(approximate_rows.tolist())) / len(exact_rows))
+    return {
+        'mode': quantized_index.mode,
+        f'recall@{n_results}': float(np.mean(recalls)),
+        'exact_ms': 1000 * exact_seconds / len(query_rows),
+        'quantized_ms': 1000 * quantized_seconds / len(query_rows),
+        'float_bytes': int(len(vector_index) * vector_index.dim * 4),
+        'quantized_bytes': int(quantized_index.nbytes),
+    }
+
+
+if __name__ == '__main__':
+    from vector_index import get_vector_index
+    index = get_vector_index()
+    for quantization_mode in (INT8, BINARY):
+        print(measure_recall(index, build_quantized_index(index, quantization_mode)))
@@ -0,0 +1,54 @@
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """A thread-safe token bucket that refills continuously at `rate_per_minute`"""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.refill_per_second = rate_per_minute / 60.0
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount=1):
+        """Blocks until `amount` tokens are available and takes them"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.refill_per_second
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Keeps API calls under both a requests/minute and a tokens/minute budget"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, num_tokens):
+        self.requests.acquire(1)
+        self.tokens.acquire(num_tokens)
+
+
+def estimate_tokens(messages, max_output_tokens=500):
+    """Roughly estimates the tokens a chat completion will use (~4 characters per token)"""
+    return sum(len(message['content']) for message in messages) // 4 + max_output_tokens
+
+
+def backoff_delays(max_retries=6, base_delay=1.0, max_delay=60.0):
+    """Yields exponentially growing, jittered delays between retries"""
+    for attempt in range(max_retries):
+        yield min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
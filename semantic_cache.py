@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+SEMANTIC_CACHE_THRESHOLD = 0.95  # minimum cosine similarity for a cached answer to be reused
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # seconds
+
+
+class SemanticCache:
+    """An LRU/TTL cache of answers keyed by query embedding, model, and corpus version"""
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl=SEMANTIC_CACHE_TTL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.corpus_version = None
+        self.entries = OrderedDict()  # key -> (embedding, model, answer, created_at)
+        self.hits = 0
+        self.misses = 0
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def _invalidate_if_stale(self, corpus_version):
+        if corpus_version != self.corpus_version:
+            self.entries.clear()
+            self.corpus_version = corpus_version
+
+    def _expire(self, now):
+        for key in [key for key, entry in self.entries.items() if now - entry[3] > self.ttl]:
+            del self.entries[key]
+
+    def lookup(self, query_embedding, model, corpus_version):
+        """Returns the cached answer for the most similar query, or None if none clears the threshold"""
+        with self._lock:
+            self._invalidate_if_stale(corpus_version)
+            self._expire(time.monotonic())
+            keys = [key for key, entry in self.entries.items() if entry[1] == model]
+            if not keys:
+                self.misses += 1
+                return None
+            embeddings = np.stack([self.entries[key][0] for key in keys])
+            similarities = embeddings @ np.asarray(query_embedding, dtype=np.float32).ravel()
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(keys[best])
+            self.hits += 1
+            return self.entries[keys[best]][2]
+
+    def store(self, query_embedding, model, corpus_version, answer):
+        with self._lock:
+            self._invalidate_if_stale(corpus_version)
+            self.entries[self._next_key] = (np.asarray(query_embedding, dtype=np.float32).ravel(), model, answer,
+                                            time.monotonic())
+            self._next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+SEMANTIC_CACHE = SemanticCache()
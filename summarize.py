@@ -1,10 +1,37 @@
 from langchain.text_splitter import MarkdownHeaderTextSplitter
-from openai import OpenAI
 from pprint import pprint
 import dotenv
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import BACKGROUND, chat_completion
+from rate_limit import RateLimiter, estimate_tokens
 
 dotenv.load_dotenv()
 
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_REQUESTS_PER_MINUTE = 500
+SUMMARY_TOKENS_PER_MINUTE = 60000
+RATE_LIMITER = RateLimiter(SUMMARY_REQUESTS_PER_MINUTE, SUMMARY_TOKENS_PER_MINUTE)
+SECTION_MAX_WORKERS = 8
+SUMMARY_CACHE_DIR = './summary_cache'
+
+SECTION_PROMPT_TEMPLATE = (
+    "Summarize the following snippet of a Stratechery {article_type} in markdown. "
+    "Use 'Ben' when describing the author and his points in the third person. Do not use descriptive clauses like 'in the interview,'. "
+    "Be concise and objective, with 3-5 sentences per section. Return a plain text paragraph, no formatting or new lines: {section_content}"
+)
+
+ARTICLE_PROMPT_TEMPLATE = (
+    "The following is a set of summaries from a Stratechery article split by its sections: {section_summaries} "
+    "Take these and place it in a packaged, paragraph summary about the article. "
+    "In the event of an interview, intuit what the name abbreviations are from the section headers and use their names. "
+    "Mention the name of every section. The summary should use all the points mentioned below. "
+    "Return plain text paragraph, no formatting and no new lines."
+)
+
 headers_to_split_on = [
     ("#", "Header 1"),
     ("##", "Header 2"),
@@ -13,44 +40,63 @@ headers_to_split_on = [
 ]
 
 
-def summarize_article(article_title, markdown_content):
-    """Summarizes the content of a given markdown string using OpenAI's GPT-3.5 model and map-reduce approach"""
+def create_completion(messages, model=SUMMARY_MODEL):
+    """Creates a chat completion within the summarization rate limit, as background work that yields to chat"""
+    RATE_LIMITER.acquire(estimate_tokens(messages))
+    return chat_completion(model, messages, priority=BACKGROUND)
+
+
+def cache_key(model, prompt_template, **prompt_values):
+    """Returns a content-addressed key for a (model, prompt template, prompt text) combination"""
+    payload = json.dumps([model, prompt_template, prompt_values], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cached_completion(prompt_template, model=SUMMARY_MODEL, **prompt_values):
+    """Returns the completion for a prompt, reading it from the on-disk summary cache when possible"""
+    key = cache_key(model, prompt_template, **prompt_values)
+    cache_path = os.path.join(SUMMARY_CACHE_DIR, f"{key}.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            return json.load(file)['content']
+
+    completion = create_completion(
+        [{"role": "system", "content": prompt_template.format(**prompt_values)}],
+        model=model,
+    )
+    content = completion.choices[0].message.content
+
+    os.makedirs(SUMMARY_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({'model': model, 'content': content}, file)
+    os.replace(tmp_path, cache_path)
+    return content
+
+
+def summarize_article(article_title, markdown_content, max_workers=SECTION_MAX_WORKERS):
+    """Summarizes the content of a given markdown string using OpenAI's GPT-3.5 model and map-reduce approach.
+    Sections are summarized concurrently and every summary is cached, so only new or changed sections hit the API"""
     if "* * *" in markdown_content:
         markdown_content = ''.join(markdown_content.split("* * *")[:-1])
 
     markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on, strip_headers=False)
     section_splits = markdown_splitter.split_text(markdown_content)
 
-    openai_client = OpenAI()
-
     article_type = "interview" if "Interview" in article_title else "article"
 
-    section_summaries = []
-    for i, section in enumerate(section_splits):
-        section_content = section.page_content
+    def summarize_section(section):
         section_header = list(section.metadata.values())[-1]
-        section_completion = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": f"Summarize the following snippet of a Stratechery {article_type} in markdown. "
-                                              f"Use 'Ben' when describing the author and his points in the third person. Do not use descriptive clauses like 'in the interview,'. "
-                                              f"Be concise and objective, with 3-5 sentences per section. Return a plain text paragraph, no formatting or new lines: {section_content}"}
-            ]
-        )
-        section_summary = section_header + ": " + section_completion.choices[0].message.content
-        section_summaries.append(section_summary)
+        section_summary = cached_completion(SECTION_PROMPT_TEMPLATE,
+                                            article_type=article_type, section_content=section.page_content)
+        return section_header + ": " + section_summary
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        section_summaries = list(executor.map(summarize_section, section_splits))
+    for i, section_summary in enumerate(section_summaries):
         print(f"({i + 1}/{len(section_splits)}): {section_summary}")
 
-    section_summaries = '\n'.join(section_summaries)
-    article_completion = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": f"The following is a set of summaries from a Stratechery article split by its sections: {section_summaries} "
-                                          f"Take these and place it in a packaged, paragraph summary about the article. "
-                                          f"In the event of an interview, intuit what the name abbreviations are from the section headers and use their names. "
-                                          f"Mention the name of every section. The summary should use all the points mentioned below. "
-                                          f"Return plain text paragraph, no formatting and no new lines."}
-        ]
-    )
-    print("Full summary: " + article_completion.choices[0].message.content + "\n\n")
-    return article_completion.choices[0].message.content
+    article_summary = cached_completion(ARTICLE_PROMPT_TEMPLATE,
+                                        section_summaries='\n'.join(section_summaries))
+    print("Full summary: " + article_summary + "\n\n")
+    return article_summary
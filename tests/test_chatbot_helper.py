@@ -0,0 +1,179 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+
+import chatbot_helper
+from vector_index import VectorIndex
+
+
+def stream_chunk(content=None, tool_calls=None):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))])
+
+
+def tool_call_delta(name, arguments, index=0, call_id="call_0"):
+    return SimpleNamespace(index=index, id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def answer_stream(*texts):
+    return iter([stream_chunk(content=text) for text in texts])
+
+
+def test_global_retrieval_gets_token_budget_as_keyword(monkeypatch):
+    """A tool call naming no known article falls back to the global search"""
+    calls = []
+
+    def fake_fetch(query_text, article_titles=None, token_budget=None):
+        calls.append((query_text, article_titles, token_budget))
+        return {"Some Article": {"url": "https://example.com", "documents": ["chunk"], "distances": [0.1]}}
+
+    arguments = json.dumps({"articles": ["No Such Article"]})
+    monkeypatch.setattr(chatbot_helper, "fetch_article_chunks_from_query_search", fake_fetch)
+    monkeypatch.setattr(chatbot_helper, "fetch_article_summaries", lambda titles: [])
+    monkeypatch.setattr(chatbot_helper, "pack_context", lambda summaries, chunks, model, budget: ("chunk", 1))
+    monkeypatch.setattr(chatbot_helper, "call_openai", lambda messages, **kwargs: iter(
+        [stream_chunk(tool_calls=[tool_call_delta("fetch_article_chunks_for_rag", arguments)])]))
+    monkeypatch.setattr(chatbot_helper, "chat_completion", lambda model, messages, *args, **kwargs: answer_stream("Answer"))
+
+    messages = [{"role": "system", "content": "system"}]
+    answer = "".join(chatbot_helper.stream_chat_completion_with_rag("question", messages, "gpt-3.5-turbo"))
+
+    assert answer == "Answer"
+    assert calls == [("question", None, chatbot_helper.context_token_budget("gpt-3.5-turbo"))]
+    assert messages[-1]["role"] == "tool" and messages[-1]["content"] == "chunk"
+
+
+def test_title_filtered_retrieval_starts_while_the_tool_call_streams(monkeypatch):
+    calls = []
+    fetched = threading.Event()
+    arguments = json.dumps({"articles": ["Known Article"]})
+
+    def fake_fetch(query_text, article_titles=None, token_budget=None):
+        calls.append(article_titles)
+        fetched.set()
+        return {}
+
+    def fake_call_openai(messages, **kwargs):
+        yield stream_chunk(tool_calls=[tool_call_delta("fetch_article_chunks_for_rag", arguments[:10])])
+        yield stream_chunk(tool_calls=[tool_call_delta(None, arguments[10:], call_id=None)])
+        assert fetched.wait(timeout=5)  # before the stream has ended
+        yield stream_chunk(content=None)
+
+    summaries = [{"title": "Known Article", "summary": "summary", "url": "https://example.com"}]
+    monkeypatch.setattr(chatbot_helper, "fetch_article_chunks_from_query_search", fake_fetch)
+    monkeypatch.setattr(chatbot_helper, "fetch_article_summaries", lambda titles: summaries)
+    monkeypatch.setattr(chatbot_helper, "pack_context", lambda summaries, chunks, model, budget: ("context", 1))
+    monkeypatch.setattr(chatbot_helper, "call_openai", fake_call_openai)
+    monkeypatch.setattr(chatbot_helper, "chat_completion", lambda model, messages, *args, **kwargs: answer_stream("Answer"))
+
+    messages = [{"role": "system", "content": "system"}]
+    answer = "".join(chatbot_helper.stream_chat_completion_with_rag("question", messages, "gpt-3.5-turbo"))
+
+    assert answer == "Answer"
+    assert calls == [["Known Article"]]  # the global search never ran
+
+
+def test_answers_after_every_round_goes_to_title_lookups(monkeypatch):
+    final_calls = []
+
+    def fake_chat_completion(model, messages, priority=chatbot_helper.INTERACTIVE, **kwargs):
+        final_calls.append(kwargs)
+        return answer_stream("From ", "the catalog")
+
+    monkeypatch.setattr(chatbot_helper, "search_article_titles", lambda **arguments: [])
+    monkeypatch.setattr(chatbot_helper, "call_openai", lambda messages, **kwargs: iter(
+        [stream_chunk(tool_calls=[tool_call_delta("search_article_titles", '{"keywords": ["AI"]}')])]))
+    monkeypatch.setattr(chatbot_helper, "chat_completion", fake_chat_completion)
+
+    messages = [{"role": "system", "content": "system"}]
+    answer = "".join(chatbot_helper.stream_chat_completion_with_rag("question", messages, "gpt-3.5-turbo"))
+
+    assert answer == "From the catalog"
+    assert final_calls[0]["tool_choice"] == "none"
+    assert sum(message["role"] == "tool" for message in messages) == chatbot_helper.MAX_TOOL_ROUNDS
+
+
+def search_tool_call(arguments):
+    return {"id": "call_0", "type": "function", "function": {"name": "search_article_titles", "arguments": arguments}}
+
+
+def test_search_tool_call_reports_bad_arguments_to_the_model():
+    for arguments in ('{"keyword": "AI"}', '{"start_date": "March 2024"}', '{"keywords": ', '["AI"]',
+                      '{"keywords": 2024}', '{"keywords": {"title": "AI"}}', '{"end_date": 20240301}'):
+        message = chatbot_helper.answer_search_tool_call(search_tool_call(arguments))
+        assert message["role"] == "tool"
+        assert "error" in json.loads(message["content"])
+
+
+def test_article_tool_call_reports_bad_arguments_to_the_model(monkeypatch):
+    monkeypatch.setattr(chatbot_helper, "fetch_article_summaries", lambda titles: [])
+    for arguments in ('{"articles": ', '[]', '{"articles": "Aggregation Theory"}', '{"articles": [1, 2]}'):
+        tool_call = {"id": "call_0", "type": "function",
+                     "function": {"name": "fetch_article_chunks_for_rag", "arguments": arguments}}
+        [message] = chatbot_helper.answer_tool_calls("question", [tool_call], "gpt-3.5-turbo")
+        assert message["role"] == "tool"
+        assert "error" in json.loads(message["content"])
+
+
+def test_search_tool_call_searches_the_catalog(monkeypatch):
+    monkeypatch.setattr(chatbot_helper, "search_article_titles", lambda **arguments: [arguments])
+    message = chatbot_helper.answer_search_tool_call(search_tool_call('{"keywords": "AI", "end_date": "2024-03-01"}'))
+    assert json.loads(message["content"]) == [{"keywords": "AI", "end_date": "2024-03-01"}]
+
+
+def test_semantic_cache_warm_up_runs_at_background_priority(monkeypatch, tmp_path):
+    priorities = []
+
+    def fake_call_openai(messages, priority=chatbot_helper.INTERACTIVE, **kwargs):
+        priorities.append(priority)
+        return answer_stream("Warm")
+
+    monkeypatch.setattr(chatbot_helper.instrumentation, "METRICS_FILE", str(tmp_path / "metrics.jsonl"))
+    monkeypatch.setattr(chatbot_helper, "embed_query", lambda text: None)
+    monkeypatch.setattr(chatbot_helper, "get_corpus_version", lambda: "v1")
+    monkeypatch.setattr(chatbot_helper.SEMANTIC_CACHE, "lookup", lambda *args: None)
+    monkeypatch.setattr(chatbot_helper.SEMANTIC_CACHE, "store", lambda *args: None)
+    monkeypatch.setattr(chatbot_helper, "call_openai", fake_call_openai)
+
+    chatbot_helper.warm_semantic_cache(["Who is Ben Thompson?"], "gpt-3.5-turbo")
+    assert priorities == [chatbot_helper.BACKGROUND]
+
+
+def test_articles_without_a_summary_are_still_searched(monkeypatch, tmp_path):
+    rows = np.eye(4, dtype=np.float32)
+    vector_index = VectorIndex(str(tmp_path / "chunks"), dim=4)
+    vector_index.upsert(["0_A", "0_B", "0_C"], rows[:3], ["a", "b", "c"], [{"title": "A"}, {"title": "B"}, {"title": "C"}])
+    article_index = VectorIndex(str(tmp_path / "articles"), dim=4)
+    article_index.upsert(["a", "b"], rows[:2], ["A\nsummary", "B\nsummary"], [{"title": "A"}, {"title": "B"}])
+    monkeypatch.setattr(chatbot_helper, "get_vector_index", lambda: vector_index)
+    monkeypatch.setattr(chatbot_helper, "get_article_index", lambda: article_index)
+    monkeypatch.setattr(chatbot_helper, "HIERARCHICAL_TOP_ARTICLES", 1)
+
+    assert chatbot_helper.find_relevant_articles(rows[0]) == ["A", "C"]
+    article_index.upsert(["c"], rows[2:3], ["C\nsummary"], [{"title": "C"}])
+    assert chatbot_helper.find_relevant_articles(rows[0]) == ["A"]
+
+
+def test_async_stream_passes_models_and_priority_through(monkeypatch):
+    requests = []
+
+    async def fake_achat_completion(model, messages, priority=chatbot_helper.INTERACTIVE, stream=False, **kwargs):
+        requests.append((model, priority, kwargs.get("tool_choice")))
+
+        async def stream_chunks():
+            yield stream_chunk(tool_calls=[tool_call_delta("search_article_titles", '{"keywords": "AI"}')])
+        return stream_chunks()
+
+    async def read_answer():
+        return [text async for text in chatbot_helper.astream_chat_completion_with_rag(
+            "question", [{"role": "system", "content": "system"}], "gpt-4-turbo-preview",
+            priority=chatbot_helper.BACKGROUND)]
+
+    monkeypatch.setattr(chatbot_helper, "search_article_titles", lambda **arguments: [])
+    monkeypatch.setattr(chatbot_helper, "achat_completion", fake_achat_completion)
+    asyncio.run(read_answer())
+
+    rounds = [(chatbot_helper.TOOL_CALL_MODEL, chatbot_helper.BACKGROUND, None)] * chatbot_helper.MAX_TOOL_ROUNDS
+    assert requests == rounds + [("gpt-4-turbo-preview", chatbot_helper.BACKGROUND, "none")]
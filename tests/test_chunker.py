@@ -0,0 +1,28 @@
+from chunker import iter_chunk_spans
+
+QUOTED_MARKDOWN = """# Quotes
+
+He said, “The headset is the product.” Then he paused (for effect.) And he asked, "Who will buy it?" Nobody knew.
+‘Time will tell.’ The end [of the story.]"""
+
+
+def non_whitespace(text):
+    return ''.join(text.split())
+
+
+def test_chunks_keep_closing_quotes_and_brackets():
+    spans = list(iter_chunk_spans(QUOTED_MARKDOWN, 'quotes', chunk_size=45))
+    texts = [span.text(QUOTED_MARKDOWN) for span in spans]
+    assert len(texts) > 2
+    assert ''.join(non_whitespace(text) for text in texts) == non_whitespace(QUOTED_MARKDOWN)
+    for closed in ('product.”', 'effect.)', 'it?"', 'tell.’', 'story.]'):
+        assert any(text.endswith(closed) or closed + ' ' in text for text in texts)
+
+
+def test_chunks_round_trip_the_markdown_with_overlap():
+    spans = list(iter_chunk_spans(QUOTED_MARKDOWN, 'quotes', chunk_size=80, chunk_overlap=40))
+    assert all(span.text(QUOTED_MARKDOWN) == QUOTED_MARKDOWN[span.start:span.end] for span in spans)
+    covered = set()
+    for span in spans:
+        covered.update(range(span.start, span.end))
+    assert all(i in covered or QUOTED_MARKDOWN[i].isspace() for i in range(len(QUOTED_MARKDOWN)))
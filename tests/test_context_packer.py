@@ -0,0 +1,50 @@
+import context_packer
+from context_packer import pack_context
+
+
+class WhitespaceEncoder:
+    """Counts one token per word, so budgets are easy to reason about without tiktoken's download"""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+def words(count, word):
+    return ' '.join([word] * count)
+
+
+def test_packs_most_relevant_chunks_within_the_budget(monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoder', lambda model: WhitespaceEncoder())
+    chunks = {
+        'Near': {'url': 'https://near', 'documents': [words(40, 'near')], 'distances': [0.1]},
+        'Middle': {'url': 'https://middle', 'documents': [words(40, 'middle')], 'distances': [0.2]},
+        'Far': {'url': 'https://far', 'documents': [words(10, 'far')], 'distances': [0.3]},
+    }
+
+    content, tokens = pack_context([], chunks, token_budget=70)
+
+    # 'Middle' doesn't fit after 'Near', but the smaller, less relevant 'Far' still does
+    assert 'near' in content and 'far' in content and 'middle' not in content
+    assert content.index('[Near]') < content.index('[Far]')
+    assert tokens <= 70
+
+
+def test_summaries_lead_their_article_and_duplicates_are_dropped(monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoder', lambda model: WhitespaceEncoder())
+    chunk = "Aggregators own demand and commoditize supply"
+    chunks = {'Aggregation': {'url': 'https://a', 'documents': [chunk, chunk + "."], 'distances': [0.1, 0.2]}}
+    summaries = [{'title': 'Aggregation', 'summary': "Why aggregators win", 'url': 'https://a'}]
+
+    content, _ = pack_context(summaries, chunks, token_budget=1000)
+
+    assert content.count("Aggregators own demand") == 1
+    lines = content.split('\n')
+    assert lines[:3] == ['[Aggregation](https://a)', 'Summary: Why aggregators win', chunk]
+
+
+def test_budget_defaults_to_the_models(monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoder', lambda model: WhitespaceEncoder())
+    monkeypatch.setitem(context_packer.CONTEXT_TOKEN_BUDGETS, 'small-model', 20)
+    chunks = {'Long': {'url': 'https://long', 'documents': [words(30, 'long')], 'distances': [0.1]}}
+
+    assert pack_context([], chunks, 'small-model') == ('', 0)
@@ -0,0 +1,27 @@
+import numpy as np
+
+import dedup
+from vector_index import VectorIndex
+
+FOOTER = ("This Update will be available as a podcast later today. To receive it in your podcast player, visit your "
+          "account page and add the Stratechery feed to the podcast app of your choice.")
+
+
+def chunk(chunk_id, url, text):
+    return {'chunk_id': chunk_id, 'page_content': text, 'metadata': {'url': url}}
+
+
+def test_new_chunks_are_checked_against_chunks_stored_before_signatures(tmp_path, monkeypatch):
+    monkeypatch.setattr(dedup, 'DEDUP_REPORT_FILE', str(tmp_path / 'report.jsonl'))
+    vector_index = VectorIndex(str(tmp_path), dim=4)
+    vector_index.upsert(['0_old'], np.ones((1, 4), dtype=np.float32), [FOOTER], [{'url': 'old', 'title': 'Old'}])
+
+    index = dedup.DuplicateIndex(str(tmp_path))
+    dedup.backfill(index, vector_index)
+    assert len(dedup.DuplicateIndex(str(tmp_path))) == 1
+
+    kept = list(dedup.drop_near_duplicates([chunk('0_new', 'new', "A new argument about aggregation theory and "
+                                                                "the future of the open web, in several words."),
+                                            chunk('1_new', 'new', FOOTER)], index))
+    assert [kept_chunk['chunk_id'] for kept_chunk in kept] == ['0_new']
+    assert index.num_dropped == 1
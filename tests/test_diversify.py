@@ -0,0 +1,65 @@
+import numpy as np
+
+import context_packer
+from diversify import expand_to_passages, maximal_marginal_relevance
+from vector_index import VectorIndex
+
+
+class WhitespaceEncoder:
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+def unit_rows(*rows):
+    rows = np.asarray(rows, dtype=np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def test_mmr_skips_near_duplicates_of_picked_results():
+    query = unit_rows([1, 0])[0]
+    embeddings = unit_rows([1, 0.3], [1, 0.32], [1, -0.35])
+    # The second row is nearly as relevant as the first but almost identical to it
+    assert maximal_marginal_relevance(query, embeddings, 2).tolist() == [0, 2]
+    assert maximal_marginal_relevance(query, embeddings, 2, lambda_mult=1.0).tolist() == [0, 1]
+    assert maximal_marginal_relevance(query, embeddings, 5).tolist() == [0, 2, 1]
+    assert len(maximal_marginal_relevance(query, embeddings[:0], 3)) == 0
+
+
+def article_index(tmp_path, num_chunks, overlap=0):
+    """An article of num_chunks chunks, each five words long, where consecutive chunks share `overlap` characters"""
+    index = VectorIndex(str(tmp_path), dim=2)
+    documents, metadatas, start = [], [], 0
+    for chunk_index in range(num_chunks):
+        document = ' '.join(f"w{chunk_index}_{word}" for word in range(5))
+        documents.append(document)
+        metadatas.append({'title': 'Article', 'url': 'https://article', 'chunk_index': chunk_index,
+                          'start': start, 'end': start + len(document)})
+        start += len(document) - overlap
+    index.upsert([f"{i}_Article" for i in range(num_chunks)], unit_rows(*[[1, i] for i in range(num_chunks)]),
+                 documents, metadatas)
+    return index
+
+
+def test_picked_chunks_grow_into_their_neighbours_within_the_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoder', lambda model: WhitespaceEncoder())
+    index = article_index(tmp_path, 6)
+
+    # Chunks 1 and 4 were picked: 20 tokens hold them plus only the better one's neighbours, 0 and 2
+    passages = expand_to_passages(index, np.array([4, 1]), np.array([0.3, 0.1]), token_budget=20)
+    assert passages['Article']['distances'] == [0.1, 0.3]
+    assert passages['Article']['documents'][0].split() == ' '.join(index.documents[0:3]).split()
+    assert passages['Article']['documents'][1] == index.documents[4]
+
+    # With room for every neighbour, chunks 0-5 merge into one passage
+    passages = expand_to_passages(index, np.array([4, 1]), np.array([0.3, 0.1]), token_budget=1000)
+    assert passages['Article']['distances'] == [0.1]
+    assert passages['Article']['documents'][0].split() == ' '.join(index.documents).split()
+
+
+def test_overlapping_neighbours_are_joined_without_repeating_text(tmp_path, monkeypatch):
+    monkeypatch.setattr(context_packer, 'get_encoder', lambda model: WhitespaceEncoder())
+    index = article_index(tmp_path, 2, overlap=5)
+
+    passages = expand_to_passages(index, np.array([0]), np.array([0.1]), token_budget=1000)
+    expected = index.documents[0] + index.documents[1][5:]
+    assert passages['Article']['documents'] == [expected]
@@ -0,0 +1,38 @@
+import threading
+from types import SimpleNamespace
+
+import history
+from history import ConversationHistory
+
+
+def conversation(num_turns):
+    messages = []
+    for turn in range(num_turns):
+        messages.append({"role": "user", "content": f"question {turn}"})
+        messages.append({"role": "assistant", "content": f"answer {turn}"})
+    return messages
+
+
+def test_older_turns_are_summarized_without_blocking_the_answer(monkeypatch):
+    release = threading.Event()
+    summarized = []
+
+    def fake_chat_completion(model, messages, priority=None, **kwargs):
+        summarized.append((messages[0]["content"], priority))
+        assert release.wait(timeout=5)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="the summary"))])
+
+    monkeypatch.setattr(history, "chat_completion", fake_chat_completion)
+    conversation_history = ConversationHistory(turns_kept=2)
+
+    # The summary is still being written: every turn is sent verbatim meanwhile
+    message_chain = conversation_history.build_messages("system", conversation(3))
+    assert [message["content"] for message in message_chain[1:]] == [message["content"] for message in conversation(3)]
+
+    release.set()
+    conversation_history.pending.result()
+    message_chain = conversation_history.build_messages("system", conversation(3))
+    assert message_chain[1]["content"] == "Summary of the earlier conversation: the summary"
+    assert [message["content"] for message in message_chain[2:]] == ["question 1", "answer 1", "question 2", "answer 2"]
+    assert len(summarized) == 1 and "question 0" in summarized[0][0]
+    assert summarized[0][1] == history.BACKGROUND
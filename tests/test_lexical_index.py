@@ -0,0 +1,64 @@
+import numpy as np
+
+from chatbot_helper import reciprocal_rank_fusion
+from lexical_index import LexicalIndex
+
+DOCUMENTS = {
+    'apple': "Apple ships the Vision Pro headset",
+    'meta': "Meta ships a cheaper headset than Apple",
+    'netflix': "Netflix raises prices again",
+    'nvidia': "Nvidia Nvidia Nvidia sells every GPU it makes",
+}
+
+
+def build_index(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(list(DOCUMENTS), list(DOCUMENTS.values()))
+    return index
+
+
+def test_bm25_prefers_rarer_terms_and_skips_stopwords(tmp_path):
+    index = build_index(tmp_path)
+    ids, scores = index.search("the Vision headset")
+    # "vision" appears in one chunk and "headset" in two, so the chunk with both ranks first; "the" scores nothing
+    assert ids == ['apple', 'meta']
+    assert scores[0] > scores[1] > 0
+    assert index.search("the")[0] == []
+
+
+def test_bm25_term_frequency_saturates(tmp_path):
+    index = build_index(tmp_path)
+    index.add(['nvidia_once'], ["Nvidia sells every GPU it makes"])
+    ids, scores = index.search("nvidia")
+    assert ids == ['nvidia', 'nvidia_once']
+    assert scores[0] < 3 * scores[1]  # three mentions score well under three times one
+
+
+def test_saved_postings_score_like_the_unsaved_delta(tmp_path):
+    index = build_index(tmp_path)
+    before = index.search("apple headset")
+    index.save()
+    reloaded = LexicalIndex(str(tmp_path))
+    after = reloaded.search("apple headset")
+    assert after[0] == before[0]
+    np.testing.assert_allclose(after[1], before[1], rtol=1e-6)
+
+
+def test_deleted_and_replaced_chunks_are_not_returned(tmp_path):
+    index = build_index(tmp_path)
+    index.delete(['meta'])
+    index.add(['apple'], ["Apple raises prices"])
+    assert index.search("headset")[0] == []
+    index.save()
+    reloaded = LexicalIndex(str(tmp_path))
+    assert len(reloaded) == 3
+    assert sorted(reloaded.search("prices")[0]) == ['apple', 'netflix']
+    assert reloaded.search("headset")[0] == []
+
+
+def test_reciprocal_rank_fusion_rewards_agreement_between_rankings():
+    vector_ranking = ['a', 'b', 'c']
+    lexical_ranking = ['d', 'b', 'e']
+    # 'b' is second in both lists, beating 'a' and 'd', which each top only one
+    assert reciprocal_rank_fusion(vector_ranking, lexical_ranking) == ['b', 'a', 'd', 'c', 'e']
+    assert reciprocal_rank_fusion(vector_ranking, []) == vector_ranking
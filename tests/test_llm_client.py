@@ -0,0 +1,55 @@
+import pytest
+
+from llm_client import BACKGROUND, INTERACTIVE, LLMScheduler, SchedulerBusy
+
+MODEL = 'gpt-3.5-turbo'
+
+
+def test_waiting_interactive_requests_run_before_background_work():
+    scheduler = LLMScheduler({MODEL: 1}, background_share=1.0)
+    running = scheduler.request_slot(MODEL, BACKGROUND)
+    background = scheduler.request_slot(MODEL, BACKGROUND)
+    interactive = scheduler.request_slot(MODEL, INTERACTIVE)
+    assert running.done() and not background.done() and not interactive.done()
+
+    scheduler.release(running.result())
+    assert interactive.done() and not background.done()
+    scheduler.release(interactive.result())
+    assert background.done()
+
+
+def test_background_work_is_capped_at_its_share_of_slots():
+    scheduler = LLMScheduler({MODEL: 4}, background_share=0.5)
+    background = [scheduler.request_slot(MODEL, BACKGROUND) for _ in range(3)]
+    assert [future.done() for future in background] == [True, True, False]
+
+    # Interactive requests still get the slots background work can't take
+    interactive = [scheduler.request_slot(MODEL, INTERACTIVE) for _ in range(2)]
+    assert all(future.done() for future in interactive)
+
+
+def test_full_interactive_queue_rejects_instead_of_waiting():
+    scheduler = LLMScheduler({MODEL: 1}, max_queue_depth=2)
+    running = scheduler.request_slot(MODEL, INTERACTIVE)
+    waiting = [scheduler.request_slot(MODEL, INTERACTIVE) for _ in range(2)]
+    assert scheduler.is_saturated(MODEL)
+    with pytest.raises(SchedulerBusy):
+        scheduler.request_slot(MODEL, INTERACTIVE)
+
+    # Background work always queues, and other models are unaffected
+    assert not scheduler.request_slot(MODEL, BACKGROUND).done()
+    assert scheduler.request_slot('gpt-4-turbo-preview', INTERACTIVE).done()
+
+    scheduler.release(running.result())
+    assert waiting[0].done() and not scheduler.is_saturated(MODEL)
+
+
+def test_cancelled_requests_give_their_slot_to_the_next_in_line():
+    scheduler = LLMScheduler({MODEL: 1})
+    running = scheduler.request_slot(MODEL, INTERACTIVE)
+    abandoned = scheduler.request_slot(MODEL, INTERACTIVE)
+    next_in_line = scheduler.request_slot(MODEL, INTERACTIVE)
+
+    scheduler.cancel(abandoned)
+    scheduler.release(running.result())
+    assert abandoned.cancelled() and next_in_line.done()
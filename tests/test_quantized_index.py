@@ -0,0 +1,21 @@
+import numpy as np
+
+from quantized_index import BINARY, INT8, QuantizedIndex, build_quantized_index
+from vector_index import VectorIndex
+
+
+def test_codes_are_not_used_once_rows_shift(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=8)
+    embeddings = np.random.default_rng(0).normal(size=(4, 8)).astype(np.float32)
+    index.upsert(['a', 'b', 'c', 'd'], embeddings, list('ABCD'), [{'title': title} for title in 'ABCD'])
+    for mode in (INT8, BINARY):
+        build_quantized_index(index, mode)
+        assert QuantizedIndex.exists(index, mode)
+
+    # Same number of rows, but every row after 'a' has moved up one
+    index.delete(['a'])
+    index.upsert(['e'], embeddings[:1], ['E'], [{'title': 'E'}])
+    for mode in (INT8, BINARY):
+        assert not QuantizedIndex.exists(index, mode)
+        build_quantized_index(index, mode)
+        assert QuantizedIndex.exists(index, mode)
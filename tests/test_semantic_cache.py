@@ -0,0 +1,46 @@
+import numpy as np
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_answers_are_reused_only_above_the_similarity_threshold():
+    cache = SemanticCache(threshold=0.95)
+    cache.store(unit(1, 0, 0), 'gpt-3.5-turbo', 'v1', "Aggregation Theory")
+
+    assert cache.lookup(unit(1, 0.2, 0), 'gpt-3.5-turbo', 'v1') == "Aggregation Theory"  # cosine ~0.98
+    assert cache.lookup(unit(1, 0.5, 0), 'gpt-3.5-turbo', 'v1') is None  # cosine ~0.89
+    assert cache.lookup(unit(1, 0, 0), 'gpt-4-turbo-preview', 'v1') is None  # answers are per model
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_new_corpus_version_invalidates_every_answer():
+    cache = SemanticCache()
+    cache.store(unit(1, 0), 'gpt-3.5-turbo', 'v1', "old answer")
+
+    assert cache.lookup(unit(1, 0), 'gpt-3.5-turbo', 'v2') is None
+    assert len(cache) == 0
+    cache.store(unit(1, 0), 'gpt-3.5-turbo', 'v2', "new answer")
+    assert cache.lookup(unit(1, 0), 'gpt-3.5-turbo', 'v2') == "new answer"
+
+
+def test_entries_expire_and_the_least_recently_used_is_evicted(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(semantic_cache.time, 'monotonic', lambda: now[0])
+    cache = SemanticCache(max_entries=2, ttl=60)
+    cache.store(unit(1, 0, 0), 'gpt-3.5-turbo', 'v1', "first")
+    cache.store(unit(0, 1, 0), 'gpt-3.5-turbo', 'v1', "second")
+    assert cache.lookup(unit(1, 0, 0), 'gpt-3.5-turbo', 'v1') == "first"  # now the most recently used
+
+    cache.store(unit(0, 0, 1), 'gpt-3.5-turbo', 'v1', "third")
+    assert cache.lookup(unit(0, 1, 0), 'gpt-3.5-turbo', 'v1') is None
+    assert cache.lookup(unit(1, 0, 0), 'gpt-3.5-turbo', 'v1') == "first"
+
+    now[0] = 61.0
+    assert cache.lookup(unit(1, 0, 0), 'gpt-3.5-turbo', 'v1') is None
+    assert len(cache) == 0
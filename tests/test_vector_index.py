@@ -0,0 +1,29 @@
+import json
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+
+def unit_rows(n, dim, seed):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_rows_from_a_crashed_upsert_do_not_misalign_later_appends(tmp_path):
+    index = VectorIndex(str(tmp_path), dim=4)
+    index.upsert(['a', 'b'], unit_rows(2, 4, 0), ['A', 'B'], [{'title': 'A'}, {'title': 'B'}])
+    # A crash after the embeddings were appended but before their metadata, mid-way through a metadata line
+    with open(index.embeddings_path, 'ab') as file:
+        file.write(unit_rows(3, 4, 1).tobytes())
+    with open(index.metadata_path, 'a') as file:
+        file.write(json.dumps({'id': 'c', 'document': 'C', 'metadata': {}})[:10])
+
+    reloaded = VectorIndex(str(tmp_path), dim=4)
+    assert reloaded.ids == ['a', 'b']
+    d = unit_rows(1, 4, 2)
+    reloaded.upsert(['d'], d, ['D'], [{'title': 'D'}])
+
+    reopened = VectorIndex(str(tmp_path), dim=4)
+    assert reopened.ids == ['a', 'b', 'd']
+    rows, _ = reopened.search(d[0], n_results=1)
+    assert reopened.ids[rows[0]] == 'd'
@@ -0,0 +1,35 @@
+import functools
+import threading
+
+WEAVE_PROJECT = 'stratechery-chatbot'
+
+_weave = None
+_weave_lock = threading.Lock()
+
+
+def init_tracing(project=WEAVE_PROJECT):
+    """Imports weave and starts tracing to the project. Importing weave is slow, so this runs once per process"""
+    global _weave
+    with _weave_lock:
+        if _weave is None:
+            import weave
+            weave.init(project)
+            _weave = weave
+    return _weave
+
+
+def op(function):
+    """Traces a function with weave.op once tracing has been initialized. Until then calls go straight through,
+    so importing a module with traced functions doesn't import weave"""
+    traced = None
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        nonlocal traced
+        if _weave is None:
+            return function(*args, **kwargs)
+        if traced is None:
+            traced = _weave.op()(function)
+        return traced(*args, **kwargs)
+
+    return wrapper
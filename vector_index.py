@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import numpy as np
+
+INDEX_DIR = './index'
+ARTICLE_INDEX_DIR = './index/articles'  # one row per article, embedding its summary
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+EMBEDDING_DIM = 384
+EMBEDDINGS_FILE = 'embeddings.f32'
+METADATA_FILE = 'metadata.jsonl'
+# 'int8' or 'binary' to search a quantized copy of the embeddings first and re-rank exactly (see quantized_index.py)
+VECTOR_QUANTIZATION = os.getenv('VECTOR_QUANTIZATION')
+
+_embedding_function = None
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def get_embedding_function():
+    """Returns the all-MiniLM-L6-v2 embedding function the articles were embedded with"""
+    global _embedding_function
+    if _embedding_function is None:
+        import chromadb.utils.embedding_functions as embedding_functions
+        _embedding_function = embedding_functions.DefaultEmbeddingFunction()
+    return _embedding_function
+
+
+def embed_texts(texts):
+    """Embeds a list of texts in a single forward pass and returns an (n, dim) float32 matrix"""
+    embeddings = np.asarray(get_embedding_function()(list(texts)), dtype=np.float32)
+    return normalize(embeddings)
+
+
+def normalize(embeddings):
+    """L2-normalizes the rows of a matrix so a dot product is a cosine similarity"""
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+class VectorIndex:
+    """A memory-mapped embedding matrix with parallel metadata arrays, answering top-k cosine queries"""
+
+    def __init__(self, index_dir=INDEX_DIR, dim=EMBEDDING_DIM):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.id_to_row = {}
+        self.embeddings = np.empty((0, dim), dtype=np.float32)
+        self._title_rows = None
+        self.quantized = None
+        self.lock = threading.Lock()  # serializes writes, e.g. an embedding worker's upserts and a re-chunk's deletes
+        self._load()
+
+    @property
+    def embeddings_path(self):
+        return os.path.join(self.index_dir, EMBEDDINGS_FILE)
+
+    @property
+    def metadata_path(self):
+        return os.path.join(self.index_dir, METADATA_FILE)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _load(self):
+        if not os.path.exists(self.metadata_path):
+            return
+        torn = False
+        with open(self.metadata_path, 'r') as file:
+            for line in file:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    torn = True  # the last line of an append a crash cut short
+                    break
+                self.id_to_row[row['id']] = len(self.ids)
+                self.ids.append(row['id'])
+                self.documents.append(row['document'])
+                self.metadatas.append(row['metadata'])
+        if torn:
+            self._write_metadata()
+        self._truncate_orphan_embeddings()
+        self._map_embeddings()
+
+    def _truncate_orphan_embeddings(self):
+        """Drops embedding rows past the last metadata row. Metadata is written after embeddings, so its row count
+        is the source of truth: rows a crashed upsert appended without metadata would misalign every later append"""
+        size = len(self.ids) * self.dim * np.dtype(np.float32).itemsize
+        if os.path.exists(self.embeddings_path) and os.path.getsize(self.embeddings_path) > size:
+            with open(self.embeddings_path, 'r+b') as file:
+                file.truncate(size)
+
+    def _map_embeddings(self):
+        self._title_rows = None
+        self.quantized = None  # stale once rows change; rebuild with quantized_index.build_quantized_index
+        if self.ids:
+            self.embeddings = np.memmap(self.embeddings_path, dtype=np.float32, mode='r', shape=(len(self.ids), self.dim))
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        """Writes rows to disk, overwriting existing ids in place and appending new ones"""
+        with self.lock:
+            embeddings = normalize(embeddings)
+            os.makedirs(self.index_dir, exist_ok=True)
+
+            updates, appends = [], []
+            for i, chunk_id in enumerate(ids):
+                (updates if chunk_id in self.id_to_row else appends).append(i)
+
+            if updates:
+                rows = np.memmap(self.embeddings_path, dtype=np.float32, mode='r+', shape=(len(self.ids), self.dim))
+                for i in updates:
+                    row = self.id_to_row[ids[i]]
+                    rows[row] = embeddings[i]
+                    self.documents[row] = documents[i]
+                    self.metadatas[row] = metadatas[i]
+                rows.flush()
+                del rows
+                self._write_metadata()
+
+            if appends:
+                self._truncate_orphan_embeddings()
+                with open(self.embeddings_path, 'ab') as file:
+                    file.write(embeddings[appends].tobytes())
+                with open(self.metadata_path, 'a') as file:
+                    for i in appends:
+                        self.id_to_row[ids[i]] = len(self.ids)
+                        self.ids.append(ids[i])
+                        self.documents.append(documents[i])
+                        self.metadatas.append(metadatas[i])
+                        file.write(json.dumps({'id': ids[i], 'document': documents[i], 'metadata': metadatas[i]}) + '\n')
+
+            self._map_embeddings()
+
+    def delete(self, ids):
+        """Removes rows from disk. This rewrites the index, so it is meant for the rare re-chunked article"""
+        with self.lock:
+            rows_to_delete = {self.id_to_row[chunk_id] for chunk_id in ids if chunk_id in self.id_to_row}
+            if not rows_to_delete:
+                return
+            keep = [row for row in range(len(self.ids)) if row not in rows_to_delete]
+            embeddings = np.array(self.embeddings[keep], dtype=np.float32)
+            self.ids = [self.ids[row] for row in keep]
+            self.documents = [self.documents[row] for row in keep]
+            self.metadatas = [self.metadatas[row] for row in keep]
+            self.id_to_row = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+
+            self.embeddings = np.empty((0, self.dim), dtype=np.float32)
+            tmp_path = self.embeddings_path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(embeddings.tobytes())
+            os.replace(tmp_path, self.embeddings_path)
+            self._write_metadata()
+            self._map_embeddings()
+
+    def _write_metadata(self):
+        tmp_path = self.metadata_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            for chunk_id, document, metadata in zip(self.ids, self.documents, self.metadatas):
+                file.write(json.dumps({'id': chunk_id, 'document': document, 'metadata': metadata}) + '\n')
+        os.replace(tmp_path, self.metadata_path)
+
+    @property
+    def title_rows(self):
+        """Maps each article title to the rows of its chunks"""
+        if self._title_rows is None:
+            title_rows = {}
+            for row, metadata in enumerate(self.metadatas):
+                title_rows.setdefault(metadata['title'], []).append(row)
+            self._title_rows = {title: np.asarray(rows, dtype=np.int64) for title, rows in title_rows.items()}
+        return self._title_rows
+
+    def rows_for_titles(self, titles):
+        """Returns the rows of every chunk belonging to the given article titles"""
+        title_rows = self.title_rows
+        rows = [title_rows[title] for title in titles if title in title_rows]
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    def use_quantization(self, mode):
+        """Searches a quantized copy of the embeddings first, if one has been built for the current rows"""
+        from quantized_index import QuantizedIndex
+        if QuantizedIndex.exists(self, mode):
+            self.quantized = QuantizedIndex(self, mode)
+        return self.quantized
+
+    def search(self, query_embedding, n_results=7, rows=None, exact=False):
+        """Returns the (rows, distances) of the n_results nearest chunks, nearest first.
+        If `rows` is given, only those rows are searched"""
+        if self.quantized is not None and not exact:
+            return self.quantized.search(query_embedding, n_results, rows=rows)
+        embeddings = self.embeddings if rows is None else self.embeddings[np.asarray(rows, dtype=np.int64)]
+        if len(embeddings) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_embedding = normalize(query_embedding)[0]
+        similarities = embeddings @ query_embedding
+        n_results = min(n_results, len(similarities))
+        top = np.argpartition(-similarities, n_results - 1)[:n_results]
+        top = top[np.argsort(-similarities[top])]
+        return (top if rows is None else np.asarray(rows, dtype=np.int64)[top]), 1.0 - similarities[top]
+
+    def to_query_result(self, rows, distances):
+        """Formats rows in the same shape as a Chroma query result"""
+        return {
+            'documents': [[self.documents[row] for row in rows]],
+            'distances': [[float(distance) for distance in distances]],
+            'metadatas': [[self.metadatas[row] for row in rows]],
+            'ids': [[self.ids[row] for row in rows]],
+        }
+
+    def query(self, query_embedding, n_results=7):
+        """Returns the n_results nearest chunks to the query embedding in Chroma's result shape"""
+        return self.to_query_result(*self.search(query_embedding, n_results))
+
+
+def get_vector_index(index_dir=INDEX_DIR):
+    """Returns the process-wide VectorIndex for a directory, loading it from disk on first use"""
+    index = _indexes.get(index_dir)
+    if index is None:
+        with _index_lock:
+            index = _indexes.get(index_dir)
+            if index is None:
+                index = VectorIndex(index_dir)
+                if VECTOR_QUANTIZATION and index_dir == INDEX_DIR:
+                    index.use_quantization(VECTOR_QUANTIZATION)
+                _indexes[index_dir] = index
+    return index
+
+
+def get_article_index():
+    """Returns the process-wide index of article summary embeddings"""
+    return get_vector_index(ARTICLE_INDEX_DIR)